@@ -0,0 +1,219 @@
+#
+#  Kernels.py
+#  Image kernels for the telescope and PSF, usable outside of the simulator object.
+#  SED
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#  Version 0.3.9-p4
+#
+
+import numpy as np
+import scipy as sp
+
+import scipy.signal
+
+import os
+import logging
+import hashlib
+import collections
+
+from AstroObject.util import npArrayInfo
+
+__all__ = ["ConvolutionKernels","ellipse_kern","circle_kern","tel_kern","kernel_keys"]
+
+log = logging.getLogger("SEDMachine")
+
+def ellipse_kern(major,minor,alpha=0,size=0,sizey=False,normalize=False):
+    """Generate an elliptical mask with the given major and minor axes (in array units).
+
+    `size` will determine the size of the array image, unless `size` is less than `major`, in which case the image will be automatically increased to fit the entire ellipse.
+
+    `normalize` controls whether the data is normalized or not."""
+    size /= 2
+    sizey /= 2
+
+    if size < sizey:
+        size = sizey
+    if size < major:
+        size = int(major) + 1
+    sizey = size
+
+    major = float(major)
+    minor = float(minor)
+    alpha = float(alpha)
+
+    x, y = np.mgrid[-size:size+1, -sizey:sizey+1]
+
+    d = np.sqrt(((x * np.cos(alpha) + y * np.sin(alpha))/minor)**2.0 + ((x * np.sin(alpha) + y * np.cos(alpha))/major)**2.0)
+
+    v = (d <= 1).astype(np.float)
+    if normalize:
+        return v / np.sum(v)
+    else:
+        return v
+
+
+def circle_kern(radius,size=0,sizey=0,normalize=False):
+    """Generate a Circle Kernel for modeling the \"Image of the Telescope\". The radius should be set in array units.
+
+    `size` will determine the size of the array image, unless `size` is less than `radius`, in which case the image will be automatically increased to fit the entire circle.
+
+    `normalize` controls whether the data is normalized or not. If it is not normalized, the data will have only 1.0 and 0.0 values, where 1.0 is within the radius, and 0.0 is outside the raidus."""
+    size /= 2
+    if size < radius:
+        size = int(radius)
+    else:
+        size = int(size)
+    radius = int(radius)
+    x, y = np.mgrid[-size:size+1, -size:size+1]
+    d = np.sqrt(x**2.0 + y**2.0)
+    v = (d <= radius).astype(np.float)
+    if normalize:
+        return v / np.sum(v)
+    else:
+        return v
+
+
+def tel_kern(config,major=None,minor=None):
+    """Returns the telescope kernel. This kernel is built by creating a circle (or ellipse, when `major` or `minor` are given) mask for the size of the telescope mirror, and then subtracting a telescope obscuration from the center of the mirror image. The values for all of these items are set in the ``Instrument`` section of the configuration."""
+    if major or minor:
+        TELIMG = ellipse_kern( major, minor )
+        center = ellipse_kern( major * config["Instrument"]["Tel"]["obsc"]["ratio"], minor * config["Instrument"]["Tel"]["obsc"]["ratio"], *TELIMG.shape )
+    else:
+        TELIMG = circle_kern( config["Instrument"]["Tel"]["radius"]["px"] * config["Instrument"]["density"] )
+        center = circle_kern( config["Instrument"]["Tel"]["obsc"]["px"] * config["Instrument"]["density"] ,
+            *TELIMG.shape )
+    TELIMG -= center
+    TELIMG = TELIMG / np.sum(TELIMG)
+    log.debug(npArrayInfo(TELIMG,"TELIMG"))
+    return TELIMG
+
+
+def kernel_keys(a,b,rot):
+    """Return the keys which identify the convolution kernel used for arrays of ellipse parameters, as an integer array of shape ``(4,N)``. Points which share a key share a kernel in :meth:`ConvolutionKernels.get_conv`.
+
+    The first row is 1 where an elliptical kernel will be used (both `a` and `b` are non-zero) and 0 otherwise. The remaining rows are the truncated values of `a`, `b` and `rot` (in degrees), and are zero when no elliptical kernel is used."""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    rot = np.asarray(rot)
+    elliptical = np.logical_and(a != 0,b != 0)
+    keys = np.array([elliptical,a.astype(np.int),b.astype(np.int),(rot * 180.0 / np.pi).astype(np.int)]).astype(np.int)
+    keys[1:,~elliptical] = 0
+    return keys
+
+
+class ConvolutionKernels(object):
+    """The convolved telescope and PSF kernels used to place each point of a lenslet trace.
+
+    This object holds only the configuration and kernel arrays, so that it can be sent to worker processes in place of the whole simulator.
+
+    Elliptical kernels are kept in a least-recently-used cache, keyed by the truncated values of `a`, `b` and `rot` (in degrees). Each kernel is made from its key alone (see :meth:`ellipse`), so the kernel used for a point does not depend on which points were placed before it, on evictions, or on which process placed it. The cache is bounded by a number of kernels and by the memory used by those kernels. When a directory is given, kernels are also saved there as ``.npy`` files, named by a digest of the PSF and telescope obscuration, so that later runs can skip generating them.
+
+    :param config: Configuration dictionary (see :meth:`AstroObject.AstroConfig.StructuredConfiguration.extract`)
+    :param psf: PSF kernel array
+    :param conv: Convolved PSF and circular telescope kernel array
+    :param size: Maximum number of kernels to hold in memory, or None for no limit
+    :param memory: Maximum memory for kernels held in memory, in MB, or None for no limit
+    :param directory: Directory for the on-disk kernel store, or None
+    :param load: Whether kernels are read from the on-disk store
+    :param store: Whether kernels are written to the on-disk store
+
+    """
+
+    version = 2
+
+    def __init__(self, config, psf, conv, size=None, memory=None, directory=None, load=True, store=True):
+        super(ConvolutionKernels, self).__init__()
+        self.config = config
+        self.psf = psf
+        self.conv = conv
+        self.size = size
+        self.memory = memory
+        self.directory = directory
+        self.load = load
+        self.store = store
+        self.ellipses = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.identity = self._identity()
+        if self.directory is not None and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def empty(self):
+        """Return a new kernels object with the same configuration, kernels and limits, but with an empty in-memory cache and zeroed counters. Kernels depend only on their keys, so the copy returns the same kernels as this object."""
+        return ConvolutionKernels(self.config,self.psf,self.conv,size=self.size,memory=self.memory,directory=self.directory,load=self.load,store=self.store)
+
+    def _identity(self):
+        """Return a digest of the PSF and telescope configuration which elliptical kernels depend on."""
+        digest = hashlib.md5(np.ascontiguousarray(self.psf).tostring())
+        digest.update(repr(self.psf.shape))
+        digest.update(repr(self.config["Instrument"]["Tel"]["obsc"]["ratio"]))
+        digest.update(repr(self.version))
+        return digest.hexdigest()[:16]
+
+    def _filename(self,key):
+        """The on-disk filename for a kernel key"""
+        return "%s/ECONV-%s-%d-%d-%d.npy" % ((self.directory,self.identity) + key)
+
+    def _load(self,key):
+        """Load a kernel from the on-disk store, returning None if it is not available."""
+        if self.directory is None or not self.load:
+            return None
+        try:
+            conv = np.load(self._filename(key))
+        except IOError:
+            return None
+        self.loads += 1
+        return conv
+
+    def _store(self,key,conv):
+        """Save a kernel to the on-disk store, with :func:`~SEDMachine.Objects.save_atomic` so that other processes never read a partial kernel."""
+        from Objects import save_atomic # Objects imports this module
+        if self.directory is None or not self.store:
+            return
+        save_atomic(self._filename(key),np.save,conv)
+
+    def _remember(self,key,conv):
+        """Add a kernel to the in-memory cache, evicting the least recently used kernels to stay within the limits."""
+        self.ellipses[key] = conv
+        self.nbytes += conv.nbytes
+        while len(self.ellipses) > 1 and ((self.size is not None and len(self.ellipses) > self.size) or (self.memory is not None and self.nbytes > self.memory * 1024**2)):
+            oldkey, old = self.ellipses.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def key(self,a,b,rot):
+        """Return the cache key for the given ellipse parameters. See :func:`kernel_keys`."""
+        return (int(a),int(b),int(rot * 180.0 / np.pi))
+
+    def ellipse(self,key):
+        """Return the convolved elliptical kernel for a cache key. The telescope image is made for the center of the range of `a` and `b` which share the key, so the kernel depends only on the key."""
+        ETEL = tel_kern(self.config,key[0] + 0.5,key[1] + 0.5)
+        return sp.signal.fftconvolve(self.psf,ETEL,mode='same')
+
+    def get_conv(self,wavelength,a=None,b=None,rot=None):
+        """Return a PSF for a given wavelength in the system. When ellipse parameters are given, the elliptical kernel for the truncated values of `a`, `b` and `rot` (in degrees) is returned (see :meth:`ellipse`)."""
+        if a and b:
+            key = self.key(a,b,rot)
+            if key in self.ellipses:
+                self.hits += 1
+                conv = self.ellipses.pop(key)
+                self.ellipses[key] = conv
+                return conv
+            self.misses += 1
+            conv = self._load(key)
+            if conv is None:
+                conv = self.ellipse(key)
+                self._store(key,conv)
+            self._remember(key,conv)
+            return conv
+        return self.conv
+
+    def report(self):
+        """Return a summary of the cache counters"""
+        return "Kernel cache: %d hits, %d misses (%d loaded from disk), %d evictions, %d kernels using %.1f MB" % (self.hits,self.misses,self.loads,self.evictions,len(self.ellipses),self.nbytes / 1024.0**2)
+
@@ -19,6 +19,7 @@ from matplotlib.colors import Normalize # Math Normailzation
 
 import scipy.signal
 import scipy.interpolate
+import scipy.sparse
 import yaml
 
 import shapely as sh
@@ -29,6 +30,8 @@ import logging,logging.handlers
 import time
 import copy
 import collections
+import itertools
+import functools
 import gc
 
 import AstroObject
@@ -39,9 +42,11 @@ from AstroObject.AstroImage import ImageStack,ImageFrame
 from AstroObject.AnalyticSpectra import BlackBodySpectrum, AnalyticSpectrum, FlatSpectrum, InterpolatedSpectrum
 from AstroObject.util import getVersion, npArrayInfo
 
+from Kernels import kernel_keys
+
 
 __version__ = getVersion()
-__all__ = ["SEDLimits","Lenslet","SubImage","SourcePixel"]
+__all__ = ["SEDLimits","Lenslet","SubImage","SubImageStore","SourcePixel","ShapeGrid","DispersionFits","LensletGeometryCache","ResponseOperator","ScatterSpectrum","DetectorAccumulator","DetectorShard","shard_lenslets","shard_bounds","reduce_shards","valid_lenslets","polyfit_many","block_bin","detector_tiles","tiled_convolve","quantize","load_archive","save_atomic","sweep_configurations"]
 
 class SEDLimits(Exception):
     """A Basic Error-Differentiation Class.
@@ -122,9 +127,836 @@ class SubImage(ImageFrame):
         return Object
 
 
+class SubImageStore(object):
+    """A single-file store for lenslet subimages.
+    
+    Subimages are appended, one after another, to a single raw data file. An index of the metadata for each subimage (the same metadata kept in the header of a :class:`SubImage`) is saved alongside the data file as a ``.npy`` record array, so that it can be queried without reading any subimage data. Subimages are read back through a memory map of the data file.
+    
+    :param filename: The data filename. The index is saved to the same filename with the extension ``.index.npy``.
+    :param dtype: The data type of the data file (by default, ``np.float64``). Stores must be read with the data type they were written with.
+    
+    The index has the fields ``lensletNumber``, ``cornerx``, ``cornery``, ``shapex``, ``shapey``, ``configHash`` and ``offset`` (in elements of the data file).
+    
+    """
+    
+    dtype = np.float64
+    
+    index_dtype = np.dtype([("lensletNumber",np.int64),("cornerx",np.int64),("cornery",np.int64),("shapex",np.int64),("shapey",np.int64),("configHash",np.int64),("offset",np.int64)])
+    
+    def __init__(self, filename, dtype=None):
+        super(SubImageStore, self).__init__()
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        self.filename = filename
+        self.indexname = os.path.splitext(filename)[0] + ".index.npy"
+        self.index = np.zeros((0,),dtype=self.index_dtype)
+        self.entries = {}
+        self.stream = None
+        self.data = None
+        self._records = []
+        self._offset = 0
+    
+    def open(self,mode="r"):
+        """Open the store. Mode ``"w"`` creates a new, empty store. Mode ``"r"`` reads the index and memory-maps the data file."""
+        self.close()
+        if mode == "w":
+            self.stream = open(self.filename,'wb')
+            self._records = []
+            self._offset = 0
+        elif mode == "r":
+            self.index = np.load(self.indexname)
+            self.entries = dict((int(num),i) for i,num in enumerate(self.index["lensletNumber"]))
+            if self._offset_end() > 0:
+                if os.path.getsize(self.filename) != self._offset_end() * np.dtype(self.dtype).itemsize:
+                    raise ValueError("Subimage store %s does not match its index with data type %s" % (self.filename,np.dtype(self.dtype).name))
+                self.data = np.memmap(self.filename,dtype=self.dtype,mode='r')
+        else:
+            raise ValueError("Unknown SubImageStore mode %r" % mode)
+        return self
+    
+    def _offset_end(self):
+        """The number of elements used by the subimages in the index"""
+        if len(self.index) == 0:
+            return 0
+        return int(np.max(self.index["offset"] + self.index["shapex"] * self.index["shapey"]))
+    
+    def close(self):
+        """Close the store. If the store was open for writing, the index is saved."""
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+            self.index = np.array(self._records,dtype=self.index_dtype)
+            self.entries = dict((int(num),i) for i,num in enumerate(self.index["lensletNumber"]))
+            np.save(self.indexname,self.index)
+        self.data = None
+    
+    def write(self,num,array,corner,configHash=0):
+        """Append a subimage to the store.
+        
+        :param num: Lenslet number
+        :param array: Subimage data
+        :param corner: Corner of the subimage in px
+        :param configHash: Hash of the configuration used to make the subimage
+        
+        """
+        array = np.ascontiguousarray(array,dtype=self.dtype)
+        self.stream.write(array.tostring())
+        self._records.append((num,corner[0],corner[1],array.shape[0],array.shape[1],configHash,self._offset))
+        self._offset += array.size
+    
+    def __contains__(self,num):
+        return num in self.entries
+    
+    def entry(self,num):
+        """Return the index record for a lenslet number"""
+        return self.index[self.entries[num]]
+    
+    def read(self,num):
+        """Return ``(array, corner)`` for a lenslet number. The array is a read-only view of the memory-mapped data file."""
+        record = self.entry(num)
+        start = int(record["offset"])
+        shape = (int(record["shapex"]),int(record["shapey"]))
+        array = self.data[start:start + shape[0] * shape[1]].reshape(shape)
+        return array, [int(record["cornerx"]),int(record["cornery"])]
+    
+
+class DetectorAccumulator(object):
+    """A detector image which subimages are added into in place. The image is allocated once, as a floating point copy of the initial image, and each subimage is added into a slice of it, so that no image frames are made while merging. The image is saved into an image stack once, when merging is finished.
+    
+    :param initial: The initial detector image, e.g. the blank image
+    :param dtype: The data type of the accumulated image
+    
+    """
+    
+    def __init__(self, initial, dtype=np.float):
+        super(DetectorAccumulator, self).__init__()
+        self.data = np.array(initial,dtype=dtype)
+        self.scratch = np.zeros((0,0),dtype=self.data.dtype)
+    
+    def _slices(self,shape,corner):
+        """Return the detector slices covered by an image of the given shape with its first element at `corner`. Images which do not fit on the detector raise :exc:`SEDLimits`."""
+        xstart, ystart = int(corner[0]), int(corner[1])
+        xend, yend = xstart + shape[0], ystart + shape[1]
+        if xstart < 0 or ystart < 0 or xend > self.data.shape[0] or yend > self.data.shape[1]:
+            raise SEDLimits
+        return slice(xstart,xend), slice(ystart,yend)
+    
+    def add(self,array,corner):
+        """Add an image into the detector, with its first element at `corner` (in px)."""
+        self.data[self._slices(array.shape,corner)] += array
+    
+    def add_binned(self,array,factor,corner):
+        """Bin an over-dense image by `factor` (see :func:`block_bin`), and add it into the detector with its first element at `corner` (in px). The image is binned into a re-used scratch array."""
+        shape = (array.shape[0] // factor, array.shape[1] // factor)
+        if self.scratch.shape[0] < shape[0] or self.scratch.shape[1] < shape[1]:
+            self.scratch = np.zeros((max(shape[0],self.scratch.shape[0]),max(shape[1],self.scratch.shape[1])),dtype=self.data.dtype)
+        binned = block_bin(array,factor,self.scratch[:shape[0],:shape[1]])
+        self.add(binned,corner)
+    
+    
+class DetectorShard(DetectorAccumulator):
+    """A part of the detector image, which covers only the region where its subimages are added. The region is allocated once, from `bounds`, when the subimages are known in advance (see :func:`shard_bounds`). Subimages outside of the region grow it to fit, which copies the shard. Shards are combined with :func:`reduce_shards` and added to a :class:`DetectorAccumulator` with :meth:`DetectorAccumulator.add`, at ``corner``.
+    
+    :param shape: The detector shape. Subimages which do not fit on the detector raise :exc:`SEDLimits`. If None, subimages are not checked.
+    :param dtype: The data type of the shard
+    :param bounds: The ``(corner, shape)`` of the region to allocate, or None to start empty
+    
+    """
+    
+    def __init__(self, shape=None, dtype=np.float, bounds=None):
+        super(DetectorShard, self).__init__(np.zeros((0,0)),dtype)
+        self.shape = shape
+        self.corner = np.zeros(2,dtype=np.int)
+        if bounds is not None:
+            self.corner = np.array([int(bounds[0][0]),int(bounds[0][1])])
+            self.data = np.zeros((int(bounds[1][0]),int(bounds[1][1])),dtype=self.data.dtype)
+    
+    @property
+    def bounds(self):
+        """The ``(corner, shape)`` of the region covered by this shard, or None if it is empty."""
+        if self.data.size == 0:
+            return None
+        return tuple(self.corner), self.data.shape
+    
+    def _grow(self,shape,corner):
+        """Grow the shard to cover an image of the given shape with its first element at `corner`."""
+        start = np.array([int(corner[0]),int(corner[1])])
+        end = start + shape
+        if self.data.size > 0:
+            start = np.minimum(start,self.corner)
+            end = np.maximum(end,self.corner + self.data.shape)
+        if np.all(start == self.corner) and np.all(end - start == self.data.shape):
+            return
+        data = np.zeros(tuple(end - start),dtype=self.data.dtype)
+        offset = self.corner - start
+        data[offset[0]:offset[0] + self.data.shape[0],offset[1]:offset[1] + self.data.shape[1]] = self.data
+        self.data, self.corner = data, start
+    
+    def add(self,array,corner):
+        """Add an image into the shard, with its first element at `corner` (in detector px)."""
+        if self.shape is not None:
+            xstart, ystart = int(corner[0]), int(corner[1])
+            if xstart < 0 or ystart < 0 or xstart + array.shape[0] > self.shape[0] or ystart + array.shape[1] > self.shape[1]:
+                raise SEDLimits
+        self._grow(array.shape,corner)
+        xstart, ystart = int(corner[0]) - self.corner[0], int(corner[1]) - self.corner[1]
+        self.data[xstart:xstart + array.shape[0],ystart:ystart + array.shape[1]] += array
+    
+
+def shard_lenslets(lenslets,shards):
+    """Split lenslets into at most `shards` groups of neighbouring lenslets, for :class:`DetectorShard` accumulation. Lenslets are ordered by the corner of their subimage (and then by number), and split into contiguous groups of nearly equal size, so that each group covers a compact strip of the detector. The groups depend only on the lenslets and `shards`, and not on the number of worker processes.
+    
+    :param lenslets: Iterable of :class:`Lenslet`
+    :param shards: Number of groups
+    :returns: List of lists of lenslets, in order
+    
+    """
+    ordered = sorted(lenslets,key=lambda l: (tuple(getattr(l,"subcorner",(0,0))),l.num))
+    shards = max(1,min(shards,len(ordered)))
+    bounds = [ (len(ordered) * i) // shards for i in range(shards + 1) ]
+    return [ ordered[start:end] for start,end in zip(bounds[:-1],bounds[1:]) ]
+    
+
+def shard_bounds(lenslets,factor,shape=None):
+    """Return the ``(corner, shape)`` of the region covered by the binned subimages of some lenslets, for a :class:`DetectorShard`. Each binned subimage covers ``subshape // factor`` px from ``subcorner``. Lenslets without subimage geometry are skipped, and the region is cut to the detector `shape`, if given. Returns None if no subimages are in the region."""
+    starts, ends = [], []
+    for lenslet in lenslets:
+        if not hasattr(lenslet,"subshape") or not hasattr(lenslet,"subcorner"):
+            continue
+        start = np.array([int(lenslet.subcorner[0]),int(lenslet.subcorner[1])])
+        starts.append(start)
+        ends.append(start + [ int(lenslet.subshape[0]) // factor, int(lenslet.subshape[1]) // factor ])
+    if len(starts) == 0:
+        return None
+    start, end = np.min(starts,axis=0), np.max(ends,axis=0)
+    if shape is not None:
+        start, end = np.maximum(start,0), np.minimum(end,shape)
+    if np.any(end <= start):
+        return None
+    return tuple(start), tuple(end - start)
+    
+def _union_bounds(bounds):
+    """Return the ``(corner, shape)`` covering each of a list of ``(corner, shape)`` regions (or None for empty regions)."""
+    bounds = [ bound for bound in bounds if bound is not None ]
+    if len(bounds) == 0:
+        return None
+    start = np.min([ corner for corner,shape in bounds ],axis=0)
+    end = np.max([ np.add(corner,shape) for corner,shape in bounds ],axis=0)
+    return tuple(start), tuple(end - start)
+    
+def reduce_shards(shards):
+    """Combine :class:`DetectorShard` objects with a pairwise tree reduction in a fixed order: the first shard is combined with the second, the third with the fourth, and so on, until one shard remains. The order of every floating point addition depends only on the order of `shards`, so the result is bit-identical however the shards were computed. Returns the combined shard, or None if there are no shards."""
+    shards = [ shard for shard in shards if shard is not None ]
+    if len(shards) == 0:
+        return None
+    while len(shards) > 1:
+        combined = []
+        for i in range(0,len(shards) - 1,2):
+            shard = DetectorShard(dtype=shards[i].data.dtype,bounds=_union_bounds([ part.bounds for part in shards[i:i+2] ]))
+            for part in shards[i:i+2]:
+                if part.data.size > 0:
+                    shard.add(part.data,part.corner)
+            combined.append(shard)
+        if len(shards) % 2 == 1:
+            combined.append(shards[-1])
+        shards = combined
+    return shards[0]
+    
+
+def valid_lenslets(nums,starts,xcs,ycs,ls,config,strict=True):
+    """Validate many lenslets at once. This performs the checks in :meth:`Lenslet.valid` as array operations over every lenslet, so that lenslet objects only need to be created for valid lenslets.
+    
+    The data arrays hold the spots for all lenslets, grouped so that each lenslet's spots are contiguous (in thier original order), as produced by sorting on the lenslet index.
+    
+    :param nums: Index (number) of each lenslet
+    :param starts: Index of the first spot for each lenslet
+    :param xcs: Array of camera-center x positions in mm, as given by ZEMAX
+    :param ycs: Array of camera-center y positions in mm, as given by ZEMAX
+    :param ls: Array of wavelengths
+    :param config: Configuration object
+    :param strict: In not strict mode, validator will let many lenslets which are not well-formed through the system.
+    :returns: ``(passed, distance)`` arrays, with one entry for each lenslet.
+    
+    """
+    log = logging.getLogger("SEDMachine")
+    starts = np.asarray(starts)
+    total = len(xcs)
+    counts = np.diff(np.append(starts,total))
+    group = np.repeat(np.arange(len(starts)),counts)
+    size = config["Instrument"]["image"]["size"]["mm"]
+    padding = config["Instrument"]["image"]["pad"]["mm"]
+    xcs = xcs + (size/2)
+    ycs = ycs + (size/2)
+    xpixs = np.round(xcs * config["Instrument"]["convert"]["mmtopx"],0).astype(np.int)
+    ypixs = np.round(ycs * config["Instrument"]["convert"]["mmtopx"],0).astype(np.int)
+    
+    # Data utility
+    failed = counts < 3
+    failed |= np.logical_or.reduceat((xpixs == 0) | (ypixs == 0),starts)
+    
+    # X distance calculation (all spectra should be roughly constant in x, as they are fairly well aligned)
+    jumps = np.zeros(total,dtype=np.bool)
+    jumps[1:] = (np.abs(np.diff(xpixs)) > 30) & (group[1:] == group[:-1])
+    failed |= np.logical_or.reduceat(jumps,starts)
+    
+    # Points too close to the image edge
+    inside = (xcs > 0.1) & (xcs < size - padding) & (ycs > padding) & (ycs < size - padding)
+    failed |= ~np.logical_or.reduceat(inside,starts)
+    
+    if not strict:
+        failed[:] = False
+    
+    # The spectrum should span some finite distance. The stable sorts put the first minimum and first maximum wavelength at the start of each group, matching np.argmin and np.argmax
+    startix = np.lexsort((ls,group))[starts]
+    endix = np.lexsort((-ls,group))[starts]
+    distance = np.sqrt(((xcs[endix] - xcs[startix]) + (ycs[endix] - ycs[startix]))**2)
+    failed |= distance == 0
+    
+    passed = ~failed
+    
+    # Warnings about our data go here.
+    units = np.logical_or.reduceat((ls < 1e-12) | (ls > 1e-3),starts) & passed
+    for i in np.flatnonzero(units):
+        log.warning("The wavelengths provided for lenslet %d appear as if they aren't SI units." % nums[i])
+    
+    return passed, distance
+    
+
+def _crossings(poly,density,lo=-1.0,hi=1.0,iterations=60):
+    """Return the parameter values in (`lo`, `hi`) where ``round(poly(t) * density)`` changes, i.e. where the polynomial crosses the boundary between two oversampled pixels.
+    
+    The interval is split where the polynomial turns around, so that each piece is monotonic and crosses each boundary at most once. The crossings on each piece are then found together by bisection."""
+    turns = [ np.real(r) for r in np.roots(poly.deriv().coeffs) if np.isreal(r) and lo < np.real(r) < hi ]
+    edges = np.array([lo] + sorted(turns) + [hi])
+    found = []
+    for a, b in zip(edges[:-1],edges[1:]):
+        va, vb = poly(a) * density, poly(b) * density
+        levels = np.arange(np.ceil(min(va,vb) - 0.5),np.floor(max(va,vb) - 0.5) + 1) + 0.5
+        levels = levels[(levels > min(va,vb)) & (levels < max(va,vb))]
+        if levels.size == 0:
+            continue
+        left = np.ones(levels.shape) * a
+        right = np.ones(levels.shape) * b
+        for i in xrange(iterations):
+            mid = (left + right) / 2.0
+            past = (poly(mid) * density > levels) == (vb > va)
+            right = np.where(past,mid,right)
+            left = np.where(past,left,mid)
+        found.append((left + right) / 2.0)
+    if len(found) == 0:
+        return np.array([])
+    return np.concatenate(found)
+    
+
+def _arc_length(fx,fy,edges,order=5):
+    """Return the arc length of the curve ``(fx(t), fy(t))`` between each pair of consecutive `edges`, using Gauss-Legendre quadrature."""
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    a = edges[:-1,np.newaxis]
+    h = (edges[1:] - edges[:-1])[:,np.newaxis] / 2.0
+    t = a + h * (nodes + 1.0)
+    speed = np.sqrt(fx.deriv()(t)**2.0 + fy.deriv()(t)**2.0)
+    return np.sum(speed * weights * h,axis=1)
+    
+
+def polyfit_many(xs,ys,order):
+    """Least squares polynomial fits for many sets of samples at once. This is equivalent to calling :func:`np.polyfit` for each set of samples, but solves every fit in a single vectorized call.
+    
+    :param xs: Array of sample positions, with shape ``(N,n)``, for `N` sets of `n` samples.
+    :param ys: Array of sample values, with shape ``(N,k,n)``, for `k` fits to each set of samples.
+    :param order: Order of the polynomial fits.
+    :returns: Coefficient array with shape ``(N,k,order+1)``, highest power first.
+    
+    """
+    xs = np.asarray(xs,dtype=np.float)
+    ys = np.asarray(ys,dtype=np.float)
+    lhs = xs[...,np.newaxis] ** np.arange(order,-1,-1)
+    # Scale the columns as np.polyfit does, to improve the condition of the fit.
+    scale = np.sqrt(np.sum(lhs * lhs,axis=1))
+    scale[scale == 0] = 1.0
+    lhs /= scale[:,np.newaxis,:]
+    inverse = np.linalg.pinv(lhs,xs.shape[1] * np.finfo(np.float).eps)
+    return np.einsum('nij,nkj->nki',inverse,ys) / scale[:,np.newaxis,:]
+    
+
+def block_bin(array,factor,out=None,partial=False):
+    """Bin a 2-D array by summing each `factor` by `factor` block of elements.
+    
+    When the array shape is not a multiple of `factor`, the remaining rows and columns form partial blocks at the far edges. Partial blocks are dropped unless `partial` is set, in which case they are summed into an extra row and column of the binned array.
+    
+    :param array: array to be binned
+    :param factor: binning factor
+    :param out: array with the binned shape to hold the result, or None to create a new float array
+    :param partial: whether to include partial blocks
+    :returns: binned array (`out`, when given)
+    
+    """
+    array = np.asarray(array)
+    nx, ny = array.shape
+    bx, by = nx // factor, ny // factor
+    shape = (-(-nx // factor), -(-ny // factor)) if partial else (bx, by)
+    if out is None:
+        out = np.zeros(shape)
+    elif out.shape != shape:
+        raise ValueError("Binned array has shape %r, expected %r." % (out.shape,shape))
+    # Full blocks. Reshaping a C-ordered array splits each axis into (block, element) without copying.
+    out[:bx,:by] = array[:bx * factor,:by * factor].reshape(bx,factor,by,factor).sum(axis=3).sum(axis=1)
+    if partial and nx > bx * factor:
+        out[bx,:by] = array[bx * factor:,:by * factor].reshape(nx - bx * factor,by,factor).sum(axis=2).sum(axis=0)
+    if partial and ny > by * factor:
+        out[:bx,by] = array[:bx * factor,by * factor:].reshape(bx,factor,ny - by * factor).sum(axis=2).sum(axis=1)
+    if partial and nx > bx * factor and ny > by * factor:
+        out[bx,by] = array[bx * factor:,by * factor:].sum()
+    return out
+
+def detector_tiles(shape,size=None):
+    """Yield ``(xslice, yslice)`` pairs which split an image of the given shape into square tiles of `size` px, row by row. Tiles at the far edges are cut to fit the image. If `size` is None or 0, the whole image is one tile."""
+    size = int(size) if size else max(shape)
+    for x in range(0,shape[0],size):
+        for y in range(0,shape[1],size):
+            yield slice(x,min(x + size,shape[0])), slice(y,min(y + size,shape[1]))
+    
+def tiled_convolve(data,kernel,size=None,start=(0,0),shape=None,fft=True,dtype=np.float):
+    """Convolve an image with a kernel, one tile of the image at a time (overlap-add), so that only one tile's convolution is held in memory at once. Tiles which are all zero are skipped.
+    
+    :param data: The image
+    :param kernel: The convolution kernel
+    :param size: Tile size in px (see :func:`detector_tiles`)
+    :param start: First element of the full convolution to return
+    :param shape: Shape of the part of the full convolution to return, by default, everything after `start`
+    :param fft: Whether to convolve with :func:`scipy.signal.fftconvolve` or :func:`scipy.signal.convolve`
+    :param dtype: The data type of the result
+    :returns: The part of the full convolution of `data` and `kernel` starting at `start`, with the given `shape`
+    
+    """
+    convolve = sp.signal.fftconvolve if fft else sp.signal.convolve
+    out = _overlap_output(data.shape,kernel.shape,start,shape,dtype)
+    for block,target,source in _overlap_tiles(data,kernel.shape,size,start,out.shape):
+        out[target] += convolve(block,kernel,mode="full")[source]
+    return out
+    
+def _overlap_output(data,kernel,start,shape,dtype):
+    """Return the zeroed output array for an overlap-add convolution of an image of shape `data` with a kernel of shape `kernel`, see :func:`tiled_convolve`."""
+    if shape is None:
+        shape = np.array(data) + kernel - 1 - np.array([int(start[0]),int(start[1])])
+    return np.zeros((int(shape[0]),int(shape[1])),dtype=dtype)
+    
+def _overlap_tiles(data,kernel,size,start,shape):
+    """Yield ``(block, target, source)`` for each non-zero tile of an image, where `block` is the tile, and the full convolution of the tile with a kernel of shape `kernel` should be added from its `source` slices into the `target` slices of the output. Tiles which do not reach the output are skipped. See :func:`tiled_convolve`."""
+    start = np.array([int(start[0]),int(start[1])])
+    shape = np.array(shape)
+    for xs,ys in detector_tiles(data.shape,size):
+        block = data[xs,ys]
+        if not np.any(block):
+            continue
+        corner = np.array([xs.start,ys.start]) - start
+        lo = np.maximum(corner,0)
+        hi = np.minimum(corner + block.shape + np.array(kernel) - 1,shape)
+        if np.any(hi <= lo):
+            continue
+        yield block, (slice(lo[0],hi[0]),slice(lo[1],hi[1])), (slice(lo[0] - corner[0],hi[0] - corner[0]),slice(lo[1] - corner[1],hi[1] - corner[1]))
+    
+def _fft_size(n):
+    """Return the smallest integer of at least `n` with no prime factors larger than 5, which is a fast size for FFTs."""
+    size = max(int(n),1)
+    while True:
+        remainder = size
+        for prime in (2,3,5):
+            while remainder % prime == 0:
+                remainder //= prime
+        if remainder == 1:
+            return size
+        size += 1
+    
+
+def quantize(array,dtype,saturate=True):
+    """Convert an image to an output data type. For integer types, values are rounded to the nearest integer and, if `saturate` is set, values outside the range of the type are set to the nearest value in range, rather than wrapping around. Other types are converted directly.
+    
+    :param array: The image
+    :param dtype: The output data type, e.g. ``int16``
+    :param saturate: Whether to clip values to the range of the output type
+    :returns: The converted image, and the number of pixels which were clipped
+    
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu":
+        return array.astype(dtype), 0
+    info = np.iinfo(dtype)
+    result = np.rint(array)
+    clipped = 0
+    if saturate:
+        clipped = int(np.sum((result < info.min) | (result > info.max)))
+        np.clip(result,info.min,info.max,out=result)
+    return result.astype(dtype), clipped
+    
+def load_archive(filename,**checks):
+    """Return the arrays in a ``.npz`` archive as a dictionary, or None if the file does not exist, can't be read, or does not match the `checks`. Each keyword gives the name of an array in the archive and the value it must equal, such as a format ``version`` or a ``key`` identifying the inputs the archive was made from."""
+    if not os.path.exists(filename):
+        return None
+    try:
+        archive = np.load(filename)
+        try:
+            for name,value in checks.iteritems():
+                if not np.array_equal(archive[name],np.asarray(value)):
+                    return None
+            return dict((name,archive[name]) for name in archive.files)
+        finally:
+            archive.close()
+    except (IOError,KeyError,ValueError):
+        return None
+    
+def save_atomic(filename,save,*args,**kwargs):
+    """Write a file with ``save(name,*args,**kwargs)`` (e.g. :func:`numpy.savez`), where `name` is a temporary file in the same directory, then rename the temporary file to `filename`. Other processes never read a partially written file. The temporary file keeps the extension of `filename`, so that numpy does not add one."""
+    tempName = "%s.%d.tmp%s" % (filename,os.getpid(),os.path.splitext(filename)[1])
+    save(tempName,*args,**kwargs)
+    os.rename(tempName,filename)
+    
+def _dotted(overrides,prefix=""):
+    """Flatten nested override dictionaries into a dictionary of dotted configuration keys."""
+    flat = {}
+    for key,value in overrides.iteritems():
+        name = prefix + str(key)
+        if isinstance(value,collections.Mapping):
+            flat.update(_dotted(value,name + "."))
+        else:
+            flat[name] = value
+    return flat
+
+def sweep_configurations(spec,sections=("Observation","Source")):
+    """Expand a sweep specification into a list of configuration overrides, each a dictionary of dotted configuration keys and values.
+
+    The specification is either a list of override dictionaries, or a dictionary with a ``Grid`` of dotted keys and lists of values, which is expanded into every combination of those values. A grid specification may also include ``Fixed`` overrides which are applied to every combination::
+
+        - Observation: {airmass: 1.0}
+        - Observation: {airmass: 2.0, Moon: {Phase: 0.2}}
+
+        Grid:
+          Observation.airmass: [1.0, 1.5, 2.0]
+          Observation.Moon.Phase: [0.0, 0.45]
+        Fixed:
+          Observation.exposure: 60
+
+    Overrides may only change the given configuration `sections`, since everything else is shared between the configurations of a sweep."""
+    if isinstance(spec,collections.Mapping):
+        fixed = _dotted(spec.get("Fixed",{}))
+        grid = _dotted(spec.get("Grid",{}))
+        names = sorted(grid.keys())
+        configurations = []
+        for values in itertools.product(*[ grid[name] for name in names ]):
+            overrides = dict(fixed)
+            overrides.update(zip(names,values))
+            configurations.append(overrides)
+    else:
+        configurations = [ _dotted(overrides) for overrides in spec ]
+    for overrides in configurations:
+        for name in overrides:
+            if name.split(".")[0] not in sections:
+                raise ValueError("Sweep override %r is not in %s." % (name," or ".join(sections)))
+    return configurations
+
+class DispersionFits(object):
+    """A table of the polynomial fits for many lenslets, as functions of wavelength. The fits are of the trace position (``x`` and ``y``, in px) and, when the telescope image is elliptical, of the ellipse axes (``a`` and ``b``, in o-px) and rotation (``alpha``, in radians).
+    
+    Each lenslet's fits are made in a scaled wavelength, which runs from -1 to 1 between that lenslet's shortest and longest wavelengths. All of the coefficients are held in a single array, with zeros padding the lower order fits, so that lenslets share one table rather than each owning polynomial objects. Use :meth:`row` to get the (small) table for a single lenslet.
+    
+    :param nums: Array of lenslet numbers
+    :param lmin: Array of the shortest wavelength for each lenslet
+    :param lmax: Array of the longest wavelength for each lenslet
+    :param coeffs: Coefficient array with shape ``(N,5,order+1)``, ordered as :attr:`fields`, highest power first.
+    
+    """
+    
+    fields = ("x","y","a","b","alpha")
+    
+    def __init__(self, nums, lmin, lmax, coeffs):
+        super(DispersionFits, self).__init__()
+        self.nums = np.asarray(nums)
+        self.lmin = np.asarray(lmin)
+        self.lmax = np.asarray(lmax)
+        self.coeffs = np.asarray(coeffs)
+        self.rows = dict((num,i) for i,num in enumerate(self.nums))
+    
+    @classmethod
+    def fit(cls,lenslets,config):
+        """Fit every lenslet at once. Lenslets are grouped by thier number of samples, and each group is fit with :func:`polyfit_many`.
+        
+        :param lenslets: List of :class:`Lenslet` objects
+        :param config: Configuration object
+        :returns: :class:`DispersionFits`
+        
+        """
+        orders = (config["Instrument"]["dispfitorder"],config["Instrument"]["Tel"]["dispfitorder"])
+        order = max(orders)
+        nums = np.array([lenslet.num for lenslet in lenslets])
+        lmin = np.empty(len(lenslets))
+        lmax = np.empty(len(lenslets))
+        coeffs = np.zeros((len(lenslets),len(cls.fields),order + 1))
+        groups = collections.defaultdict(list)
+        for i,lenslet in enumerate(lenslets):
+            groups[len(lenslet.ls)].append(i)
+        for rows in groups.values():
+            group = [ lenslets[i] for i in rows ]
+            ls = np.array([ lenslet.ls for lenslet in group ])
+            lmin[rows] = np.min(ls,axis=1)
+            lmax[rows] = np.max(ls,axis=1)
+            ts = cls._scaled(ls,lmin[rows,np.newaxis],lmax[rows,np.newaxis])
+            pixels = np.array([[ lenslet.xpixs, lenslet.ypixs ] for lenslet in group ])
+            coeffs[rows,:2,order - orders[0]:] = polyfit_many(ts,pixels,orders[0])
+            if config["Instrument"]["Tel"]["ellipse"]:
+                xcs, ycs, xas, yas, xbs, ybs = [ np.array([ getattr(lenslet,name) for lenslet in group ]) for name in ("xcs","ycs","xas","yas","xbs","ybs") ]
+                # Find ellipse major and minor axis from given data.
+                a = np.sqrt((xcs - xas)**2.0 + (ycs-yas)**2.0) * config["Instrument"]["convert"]["mmtopx"] * config["Instrument"]["density"]
+                b = np.sqrt((xcs - xbs)**2.0 + (ycs-ybs)**2.0) * config["Instrument"]["convert"]["mmtopx"] * config["Instrument"]["density"]
+                top = xcs - xas
+                bot = ycs - yas
+                bot[np.logical_and(top == 0,bot == 0)] = 1.0
+                alpha = np.arctan(top/bot)
+                coeffs[rows,2:,order - orders[1]:] = polyfit_many(ts,np.array([a,b,alpha]).transpose(1,0,2),orders[1])
+        return cls(nums,lmin,lmax,coeffs)
+    
+    @staticmethod
+    def _scaled(wl,lmin,lmax):
+        """Convert wavelengths to the scaled wavelength used for the fits."""
+        return (2.0 * wl - (lmax + lmin)) / (lmax - lmin)
+    
+    def row(self,num):
+        """Return a :class:`DispersionFits` holding only the fits for lenslet `num`."""
+        i = self.rows[num]
+        return type(self)(self.nums[i:i+1],self.lmin[i:i+1],self.lmax[i:i+1],self.coeffs[i:i+1])
+    
+    def scaled(self,wl,num=None):
+        """Convert wavelengths to the scaled wavelength used for lenslet `num`'s fits. `num` may be omitted for a table with a single lenslet."""
+        i = 0 if num is None else self.rows[num]
+        return self._scaled(np.asarray(wl),self.lmin[i],self.lmax[i])
+    
+    def wavelength(self,t,num=None):
+        """Convert scaled wavelengths back to wavelengths for lenslet `num`. `num` may be omitted for a table with a single lenslet."""
+        i = 0 if num is None else self.rows[num]
+        return (np.asarray(t) * (self.lmax[i] - self.lmin[i]) + (self.lmax[i] + self.lmin[i])) / 2.0
+    
+    def poly(self,field,num=None):
+        """Return the fit for `field` of lenslet `num` as a :class:`np.poly1d` of the scaled wavelength. `num` may be omitted for a table with a single lenslet."""
+        i = 0 if num is None else self.rows[num]
+        return np.poly1d(self.coeffs[i,self.fields.index(field)])
+    
+    def __call__(self,field,wl,num=None):
+        """Evaluate the fit for `field` of lenslet `num` at the given wavelengths. `num` may be omitted for a table with a single lenslet."""
+        i = 0 if num is None else self.rows[num]
+        return np.polyval(self.coeffs[i,self.fields.index(field)],self.scaled(wl,num))
+    
+
+class LensletGeometryCache(object):
+    """A file of lenslet geometry, which holds the results of :meth:`Lenslet.find_dispersion` and :meth:`Lenslet.trace_geometry` for many lenslets. The geometry depends only on the ray data and the instrument configuration, so it can be re-used by runs which change only the source or observation.
+    
+    The file is a single ``.npz`` archive. Each per-pixel array is saved as one concatenated array for all lenslets, along with the number of entries for each lenslet. The file records a key, which should identify the ray data and configuration which the geometry was made from, and a format version. Files with a different key or version are ignored.
+    
+    :param filename: The ``.npz`` filename
+    :param key: A string identifying the inputs to the geometry
+    
+    """
+    
+    version = 1
+    
+    dispersion = ("dxs","dys","dwl","drs")
+    
+    trace = ("txs","tys","twl","tdw","trs")
+    
+    names = dispersion + trace + ("fits","subshape","subcorner")
+    
+    def __init__(self, filename, key):
+        super(LensletGeometryCache, self).__init__()
+        self.filename = filename
+        self.key = key
+    
+    def load(self):
+        """Return a dictionary of lenslet states (suitable for :meth:`Lenslet.import_state`) keyed by lenslet number. The dictionary is empty if the file does not exist, can't be read, or was made from other inputs."""
+        data = load_archive(self.filename,version=self.version,key=self.key)
+        if data is None:
+            return {}
+        nums = data["nums"]
+        fits = DispersionFits(nums,data["lmin"],data["lmax"],data["coeffs"])
+        dsplit = np.cumsum(data["dcounts"])[:-1]
+        tsplit = np.cumsum(data["dcounts"] - 1)[:-1]
+        columns = {}
+        for name in self.dispersion:
+            columns[name] = np.split(data[name],dsplit)
+        for name in self.trace:
+            columns[name] = np.split(data[name],tsplit)
+        states = {}
+        for i,num in enumerate(nums):
+            state = dict((name,columns[name][i]) for name in columns)
+            state["dis"] = np.array([state["dxs"],state["dys"],state["dwl"],state["drs"]])
+            state["fits"] = fits.row(num)
+            state["subshape"] = tuple(data["subshape"][i])
+            state["subcorner"] = data["subcorner"][i]
+            state["dispersion"] = True
+            state["geometry"] = True
+            states[num] = state
+        return states
+    
+    def save(self,states):
+        """Save a dictionary of lenslet states (as produced by :meth:`Lenslet.export_state` with :attr:`names`) keyed by lenslet number. See :func:`save_atomic`."""
+        nums = np.array(sorted(states.keys()))
+        ordered = [ states[num] for num in nums ]
+        data = {}
+        data["nums"] = nums
+        data["dcounts"] = np.array([ len(state["dxs"]) for state in ordered ])
+        for name in self.dispersion + self.trace:
+            data[name] = np.concatenate([ np.asarray(state[name]) for state in ordered ])
+        data["lmin"] = np.concatenate([ state["fits"].lmin for state in ordered ])
+        data["lmax"] = np.concatenate([ state["fits"].lmax for state in ordered ])
+        data["coeffs"] = np.concatenate([ state["fits"].coeffs for state in ordered ])
+        data["subshape"] = np.array([ state["subshape"] for state in ordered ])
+        data["subcorner"] = np.array([ state["subcorner"] for state in ordered ])
+        save_atomic(self.filename,np.savez,version=np.array(self.version),key=np.array(self.key),**data)
+    
+
+class ResponseOperator(object):
+    """A linear operator from the flux of each lenslet trace point to the detector image, made from the response of each lenslet (see :meth:`Lenslet.response`). The placement, binning and merging of subimages are linear in the trace fluxes, so a detector image for new fluxes (a new source, sky or exposure) is a single sparse matrix-vector product.
+    
+    The operator is kept as a single sparse matrix, with one row for each detector pixel and a block of columns for each lenslet. It is saved as a ``.npz`` archive, along with a key identifying the geometry and kernels it was made from, and a format version. Files with a different key or version are ignored.
+    
+    :param filename: The ``.npz`` filename
+    :param key: A string identifying the inputs to the operator
+    :param shape: The detector image shape
+    
+    """
+    
+    version = 2
+    
+    def __init__(self, filename, key, shape):
+        super(ResponseOperator, self).__init__()
+        self.filename = filename
+        self.key = key
+        self.shape = tuple(shape)
+        self.matrix = sp.sparse.csc_matrix((self.shape[0] * self.shape[1],0))
+        self.columns = {}
+        self._pending = []
+    
+    def __contains__(self,num):
+        """Whether the operator includes a lenslet number"""
+        return num in self.columns or any(num == pending for pending,block in self._pending)
+    
+    def add(self,num,block):
+        """Add the response for a lenslet, as a sparse matrix with one row for each detector pixel and one column for each trace point."""
+        self._pending.append((num,block))
+    
+    def _consolidate(self):
+        """Add any pending lenslet responses to the operator matrix."""
+        if len(self._pending) == 0:
+            return
+        start = self.matrix.shape[1]
+        for num,block in self._pending:
+            self.columns[num] = (start,start + block.shape[1])
+            start += block.shape[1]
+        self.matrix = sp.sparse.hstack([self.matrix] + [ block for num,block in self._pending ]).tocsc()
+        self._pending = []
+    
+    def apply(self,fluxes):
+        """Return the detector image for the given trace fluxes.
+        
+        :param fluxes: Dictionary of trace flux arrays (``tfl``), keyed by lenslet number. Every lenslet must be in the operator.
+        :returns: Image array
+        
+        """
+        self._consolidate()
+        vector = np.zeros(self.matrix.shape[1])
+        for num,flux in fluxes.iteritems():
+            start, stop = self.columns[num]
+            if stop - start != len(flux):
+                raise ValueError("Lenslet %d has %d trace points, but its response has %d." % (num,len(flux),stop - start))
+            vector[start:stop] = flux
+        return self.matrix.dot(vector).reshape(self.shape)
+    
+    def load(self):
+        """Load the operator from its file, if the file exists and was made from the same inputs. Returns True if the operator was loaded."""
+        archive = load_archive(self.filename,version=self.version,key=self.key,shape=self.shape)
+        if archive is None:
+            return False
+        self.matrix = sp.sparse.csc_matrix((archive["data"],archive["indices"],archive["indptr"]),shape=tuple(archive["matrix"]))
+        self.columns = dict((num,(start,stop)) for num,start,stop in zip(archive["nums"],archive["starts"],archive["stops"]))
+        self._pending = []
+        return True
+    
+    def save(self):
+        """Save the operator to its file. See :func:`save_atomic`."""
+        self._consolidate()
+        nums = np.array(sorted(self.columns.keys()))
+        starts = np.array([ self.columns[num][0] for num in nums ])
+        stops = np.array([ self.columns[num][1] for num in nums ])
+        save_atomic(self.filename,np.savez,version=np.array(self.version),key=np.array(self.key),shape=np.array(self.shape),matrix=np.array(self.matrix.shape),
+            data=self.matrix.data,indices=self.matrix.indices,indptr=self.matrix.indptr,nums=nums,starts=starts,stops=stops)
+    
+
+class ScatterSpectrum(object):
+    """The real FFT (:func:`numpy.fft.rfft2`) of a scattered light kernel, zero-padded to the size needed to convolve image tiles with the kernel by overlap-add (see :meth:`convolve`). Each tile then takes one forward and one inverse real FFT, so an image which is a single tile takes one of each.
+    
+    The spectrum depends only on the kernel and the tile shape, so it is saved as a ``.npz`` archive, along with a key identifying the kernel, and a format version. Files with a different key, version or shape are ignored.
+    
+    :param filename: The ``.npz`` filename
+    :param key: A string identifying the kernel
+    :param kernel: The kernel shape
+    :param tile: The largest image tile shape which will be convolved
+    
+    """
+    
+    version = 1
+    
+    def __init__(self, filename, key, kernel, tile):
+        super(ScatterSpectrum, self).__init__()
+        self.filename = filename
+        self.key = key
+        self.kernel = (int(kernel[0]),int(kernel[1]))
+        self.tile = (int(tile[0]),int(tile[1]))
+        self.shape = (_fft_size(self.tile[0] + self.kernel[0] - 1),_fft_size(self.tile[1] + self.kernel[1] - 1))
+        self.spectrum = None
+    
+    def compute(self,kernel):
+        """Find the spectrum of a kernel, which must have the kernel shape given to this object."""
+        if kernel.shape != self.kernel:
+            raise ValueError("Kernel has shape %r, but the spectrum is for a kernel of shape %r" % (kernel.shape,self.kernel))
+        self.spectrum = np.fft.rfft2(kernel,self.shape)
+    
+    def convolve(self,data,size=None,start=(0,0),shape=None,dtype=np.float):
+        """Convolve an image with the kernel, one tile at a time (overlap-add), using the spectrum. The arguments and result are as for :func:`tiled_convolve`. Tiles must be no larger than the tile shape given to this object."""
+        out = _overlap_output(data.shape,self.kernel,start,shape,dtype)
+        for block,target,source in _overlap_tiles(data,self.kernel,size,start,out.shape):
+            if block.shape[0] > self.tile[0] or block.shape[1] > self.tile[1]:
+                raise ValueError("Tile has shape %r, but the spectrum is for tiles of at most %r" % (block.shape,self.tile))
+            out[target] += np.fft.irfft2(np.fft.rfft2(block,self.shape) * self.spectrum,self.shape)[source]
+        return out
+    
+    def load(self):
+        """Load the spectrum from its file, if the file exists and was made from the same kernel for the same tile shape. Returns True if the spectrum was loaded."""
+        archive = load_archive(self.filename,version=self.version,key=self.key,kernel=self.kernel,shape=self.shape)
+        if archive is None:
+            return False
+        self.spectrum = archive["spectrum"]
+        return True
+    
+    def save(self):
+        """Save the spectrum to its file. See :func:`save_atomic`."""
+        save_atomic(self.filename,np.savez,version=np.array(self.version),key=np.array(self.key),kernel=np.array(self.kernel),shape=np.array(self.shape),spectrum=self.spectrum)
+    
+
+def _timed(phase):
+    """Decorator for :class:`Lenslet` methods, which adds the time taken by each call to the lenslet's ``counters`` under ``<phase>_time``."""
+    name = "%s_time" % phase
+    def decorator(method):
+        @functools.wraps(method)
+        def timed(self,*args,**kwargs):
+            start = time.time()
+            try:
+                return method(self,*args,**kwargs)
+            finally:
+                self.counters[name] = self.counters.get(name,0.0) + time.time() - start
+        return timed
+    return decorator
+
 class Lenslet(ImageStack):
     """An object-representation of a lenslet. Takes approximately all of the data we know about each lenslet.
     
+    Each lenslet keeps a dictionary of ``counters`` for its work: the time spent in each phase (``dispersion_time``, ``geometry_time``, ``trace_time``, ``place_time``, ``write_time``, ``read_time`` and ``bin_time``, in seconds, where ``trace_time`` includes ``geometry_time`` when the geometry was not cached), the number of trace ``points``, the number of ``subimage`` pixels, and the ``kernel_hits`` and ``kernel_misses`` of the kernel cache while placing the trace.
+    
     :param xs: Array of camera-center x positions
     :param ys: Array of camera-center y positions
     :param p1s: Array of pupil x positions
@@ -167,9 +999,47 @@ class Lenslet(ImageStack):
         self.checked = False
         self.passed = False
         self.traced = False
+        self.geometry = False
+        self.fits = None
         self.spectrum = FlatSpectrum(0.0)
-        
-    
+        self.counters = {}
+
+
+    @classmethod
+    def from_state(cls,state,config):
+        """Rebuild a lenslet from a dictionary of attributes, as produced by :meth:`export_state`. The lenslet's constructor is not called, so no geometry is recomputed. This is used to send lenslets to worker processes.
+
+        :param state: Dictionary of lenslet attributes
+        :param config: Configuration object
+        :returns: :class:`Lenslet`
+
+        """
+        lenslet = cls.__new__(cls)
+        super(Lenslet, lenslet).__init__()
+        lenslet.dataClasses = [SubImage]
+        lenslet.log = logging.getLogger("SEDMachine")
+        lenslet.config = config
+        lenslet.counters = {}
+        lenslet.import_state(state)
+        return lenslet
+
+    def export_state(self,names):
+        """Return a dictionary of the named attributes of this lenslet (and its number). Attributes which have not been set are skipped.
+
+        :param names: Iterable of attribute names
+        :returns: dict
+
+        """
+        state = dict((name,getattr(self,name)) for name in names if hasattr(self,name))
+        state["num"] = self.num
+        return state
+
+    def import_state(self,state):
+        """Set attributes on this lenslet from a dictionary, as produced by :meth:`export_state`."""
+        for name,value in state.iteritems():
+            setattr(self,name,value)
+
+
     def reset(self):
         """Reset Flag Variables for this lenslet. Deletes any calculated varaibles."""
         self.checked = False
@@ -185,10 +1055,12 @@ class Lenslet(ImageStack):
         
         if self.traced:
             self.traced = False
+            del self.tfl
+        
+        if self.geometry:
+            self.geometry = False
             del self.txs
             del self.tys
-            del self.trd
-            del self.tfl
             del self.twl
             del self.tdw
             del self.trs
@@ -255,7 +1127,7 @@ class Lenslet(ImageStack):
             self.log.debug("Lenslet %d failed: There were fewer than three data points" % self.num)
             if strict:
                 return self.passed
-        if np.any(self.pixs.flatten == 0):
+        if np.any(self.pixs.flatten() == 0):
             self.log.debug("Lenslet %d failed: Some (x,y) were exactly zero" % self.num)
             if strict:
                 return self.passed
@@ -307,10 +1179,11 @@ class Lenslet(ImageStack):
         self.find_dispersion()
         return self.dis
         
+    @_timed("dispersion")
     def find_dispersion(self):
         """Find the dispersion (dense, pixel aligned wavelength values) for this lenslet.
         
-        To calculate dispersion, we first create an interpolation from (wavelength) -> (xpix) and (wavelength) -> (ypix). Then, using a large array of possible wavelengths (100x the number of oversampled pixel positions) we create arrays of possible overdense x and y pixel positions. These arrays are then truncated to contain only integer (overdense) pixel positions. We then calculate the arc-distance to each of these pixel positions from the start (lowest wavelength) of the spectrum. Taking only unique points along the arc-distance, we find a list of all of the unique x and y pixel positions which are illuminated by the spectrum in the over-dense sample space. This array, along with thier corresponding wavelengths and arc-distances, are stored for later use.
+        To calculate dispersion, we first fit polynomials from (wavelength) -> (xpix) and (wavelength) -> (ypix), using a wavelength scaled to run from -1 to 1 across the spectrum. We then find every wavelength where either polynomial crosses the boundary between two over-dense pixels, by splitting each polynomial into monotonic pieces and bisecting for each boundary. The over-dense pixel illuminated after each crossing is found from the middle of the section of trace which follows it, and crossings which do not change the illuminated pixel are dropped. The arc-distance to each crossing from the start (lowest wavelength) of the spectrum is found by Gauss-Legendre integration along the polynomials. This gives a list of all of the unique x and y pixel positions which are illuminated by the spectrum in the over-dense sample space, in order along the trace. This array, along with thier corresponding wavelengths and arc-distances, are stored for later use.
         
         **Variables which are used**:
         
@@ -328,6 +1201,7 @@ class Lenslet(ImageStack):
         :var dwl: wavelength of each illuminated oversampled pixel in meters
         :var drs: arc-distance along spectrum in mm
         :var dis: array of ``[dxs,dys,dwl,drs]``
+        :var fits: :class:`DispersionFits` for this lenslet, if it was not already set
         :var dispersion: boolean True
         
         """
@@ -335,29 +1209,14 @@ class Lenslet(ImageStack):
         if self.dispersion:
             return self.dispersion
         
-        if self.config["Instrument"]["Tel"]["ellipse"]:
-            # Find ellipse major and minor axis from given data.
-            self.a = np.sqrt((self.xcs - self.xas)**2.0 + (self.ycs-self.yas)**2.0) * self.config["Instrument"]["convert"]["mmtopx"] * self.config["Instrument"]["density"]
-            self.b = np.sqrt((self.xcs - self.xbs)**2.0 + (self.ycs-self.ybs)**2.0) * self.config["Instrument"]["convert"]["mmtopx"] * self.config["Instrument"]["density"]
-            top = self.xcs - self.xas
-            bot = self.ycs - self.yas
-            bot[np.logical_and(top == 0,bot == 0)] = 1.0
-            self.alpha = np.arctan(top/bot)
-            self.fa = np.poly1d(np.polyfit(self.ls, self.a, self.config["Instrument"]["Tel"]["dispfitorder"]))
-            self.fb = np.poly1d(np.polyfit(self.ls, self.b, self.config["Instrument"]["Tel"]["dispfitorder"]))
-            self.falpha = np.poly1d(np.polyfit(self.ls, self.alpha, self.config["Instrument"]["Tel"]["dispfitorder"]))
-            
-
-            
-        
-        # Interpolation to convert from wavelength to pixels.
-        #   The accuracy of this interpolation is not important.
-        #   Rather, it is used to find the pixels where the light will fall
-        #   and is fed an array that is very dense, used on this dense interpolation
-        #   and then binned back onto pixels. Thus it will be used to get a list
-        #   of all illuminated pixels.
-        fx = np.poly1d(np.polyfit(self.ls, self.xpixs, self.config["Instrument"]["dispfitorder"]))
-        fy = np.poly1d(np.polyfit(self.ls, self.ypixs, self.config["Instrument"]["dispfitorder"]))
+        # Polynomial fits to convert from wavelength to pixels, and to find the telescope image ellipse.
+        #   The accuracy of the pixel fits is not important.
+        #   Rather, they are used to find the pixels where the light will fall.
+        #   The fits are usually made for all lenslets at once, see DispersionFits.fit
+        if self.fits is None:
+            self.fits = DispersionFits.fit([self],self.config)
+        fx = self.fits.poly("x")
+        fy = self.fits.poly("y")
         
         # Find the starting and ending position of the spectra
         startix = np.argmin(self.ls)
@@ -372,56 +1231,25 @@ class Lenslet(ImageStack):
         if distance == 0:
             raise SEDLimits
         
-        # Find the length in units of (int) pixels
-        npix = (distance * self.config["Instrument"]["convert"]["mmtopx"]).astype(np.int) * self.config["Instrument"]["density"]
-        
-        # Create a data array one hundred times as dense as the number of pixels
-        #   This is the super dense array which will use the above interpolation
-        superDense_lam = np.linspace(np.min(self.ls),np.max(self.ls),npix*100)
+        # Find every wavelength where the trace crosses into a new oversampled pixel, in either x or y.
+        density = self.config["Instrument"]["density"]
+        crossings = np.unique(np.concatenate((_crossings(fx,density),_crossings(fy,density))))
         
-        # Interpolate along our really dense set of wavelengths to find all possible
-        # illuminated pixel positions in this spectrum
-        superDense_pts = np.array([fx(superDense_lam),fy(superDense_lam)])
+        # The oversampled pixel illuminated after each crossing, found at the middle of the section of trace which follows it.
+        edges = np.concatenate(([-1.0],crossings,[1.0]))
+        middle = (edges[:-1] + edges[1:]) / 2.0
+        pixels = np.round(np.array([fx(middle),fy(middle)]) * density)
         
-        # Measure the distance along our really dense set of points
-        superDense_interval = np.sqrt(np.sum(np.power(np.diff(superDense_pts,axis=1),2),axis=0))
-        superDense_distance = np.cumsum(superDense_interval)
+        # Only keep crossings where the pixel actually changes. The trace can touch a pixel boundary without crossing it.
+        changed = np.any(np.diff(pixels,axis=1) != 0,axis=0)
         
-        # Adjust the density of our points. This rounds all values to only full pixel values.
-        superDense_pts = np.round(superDense_pts * self.config["Instrument"]["density"]) / self.config["Instrument"]["density"]
-        superDense_int = (superDense_pts * self.config["Instrument"]["density"]).astype(np.int)
-        
-        # We can identify unique points using the points when the integer position ratchets up or down.
-        unique_x,unique_y = np.diff(superDense_int).astype(np.bool)
-        
-        # We want unique index to include points where either 'y' or 'x' ratchets up or down
-        unique_idx = np.logical_or(unique_x,unique_y)
-        
-        # Remove any duplicate points. This does not do so in order, so we must
-        # sort the array of unique points afterwards...
-        unique_pts = superDense_pts[:,1:][:,unique_idx]
-        
-        # An array of distances to the origin of this spectrum, can be used to find wavelength
-        # of light at each distance
-        distance = superDense_distance[unique_idx] * self.config["Instrument"]["convert"]["pxtomm"]
-        
-        # Re sort everything by distnace along the trace.
-        # Strictly, this shouldn't be necessary if all of the above functions preserved order.
-        sorted_idx = np.argsort(distance)
-        
-        # Pull out sorted valuses
-        distance = distance[sorted_idx]
-        points = unique_pts[:,sorted_idx].T
+        # Arc-distance to each crossing from the start of the spectrum.
+        distance = np.cumsum(_arc_length(fx,fy,edges[:-1]))[changed] * self.config["Instrument"]["convert"]["pxtomm"]
+        points = (pixels[:,1:][:,changed] / density).T
         self.log.debug(npArrayInfo(points,"Points"))
-            
         
-        # Pull out the original wavelengths
-        wl_orig = superDense_lam[unique_idx][sorted_idx]
-        wl = wl_orig
+        wl = self.fits.wavelength(crossings[changed])
         self.log.debug(npArrayInfo(wl,"Wavelengths"))
-        # We are getting some odd behavior, where the dispersion function seems to not cover the whole
-        # arc length and instead covers only part of it. This causes much of our arc to leave the desired
-        # and available wavelength boundaries. As such, I'm disabling the more accurate dispersion mode.
         
         # Convert to wavelength space along the dispersion spline.
         # wl = self.spline(distance)
@@ -435,17 +1263,15 @@ class Lenslet(ImageStack):
         
         return self.dispersion
                 
-    def get_trace(self,spectrum):
-        """Returns a trace of this spectrum. The trace will contain x and y over-dense pixel positions, flux values for each of those illuminated pixels, instantaneous resolution at each pixel, and wavelength of each pixel. The trace also determines the corners of the spectrum, and saves those corner positions with ample padding in the image.
+    @_timed("geometry")
+    def trace_geometry(self):
+        """Find the geometry of the trace for this lenslet. The geometry contains the x and y over-dense pixel positions of the trace in the subimage, the wavelength of each pixel, and the shape and corner of the subimage. The geometry depends only on the dispersion and the instrument configuration, not on the spectrum, so it can be re-used between runs (see :class:`LensletGeometryCache`).
         
-        To perform the trace, we first get the oversampled point positions in o-px from the ``dxs`` and ``dys`` variables. These points are saved as both ``x,y`` and ``xorig,yorig``, for later use. ``xorig,yorig`` are stored to save an unmodified copy of the points. The ``xint,yint`` variables are used to store the integer (in px) positions of each ``x,y`` pair, essentially, thier containing camera pixel. ``x,y`` are then zeroed, such that (0,0) is the upper-right corner of the spectrum to be inserted. We then calculate the size of the subimage (in ``xdist,ydist``) and adjust this size so that it is an integer number of camera pixels (px) across. This makes the binning much easier later. The pixels ``x,y`` are then padded to provide space for the PSF to be applied on all sides of the single-pixel spectrum. 
+        To find the geometry, we first get the oversampled point positions in o-px from the ``dxs`` and ``dys`` variables. These points are saved as both ``x,y`` and ``xorig,yorig``, for later use. ``xorig,yorig`` are stored to save an unmodified copy of the points. The ``xint,yint`` variables are used to store the integer (in px) positions of each ``x,y`` pair, essentially, thier containing camera pixel. ``x,y`` are then zeroed, such that (0,0) is the upper-right corner of the spectrum to be inserted. We then calculate the size of the subimage (in ``xdist,ydist``) and adjust this size so that it is an integer number of camera pixels (px) across. This makes the binning much easier later. The pixels ``x,y`` are then padded to provide space for the PSF to be applied on all sides of the single-pixel spectrum. 
         
         We then find the corner of the of the subimage. First, the corner will generally be extracted as the position with a minimum in the ``y`` direction and a maximum in the ``x`` direction. We first find the corner's position in integer camrea-px space (i.e. from ``xint,yint``, stored as ``corner``), and the corner's position in integer o-px space (i.e. from ``xorig,yorig``, stored as ``realcorner``). Converting the camera's position in integer camera-px space, we take the difference between the two corners as the ``offset``. This is the shift we must insert into ``x,y`` in order to ensure that the corner of our subimage will line up with the corner of a binned pixel. Next we add padding distances into the ``corner`` position. Finally, we use the offset to move the ``x,y`` positions to account for aligning the corner of the subimage with the corner of a full camera pixel. I will make a diagram to explain all of this shortly. Next, we add the padding values into ``xdist,ydist`` to get the full size of the subimage in o-px.
         
-        We are now ready to extract flux values from our spectrum. This is done using the ``dwl`` values as the wavelength values to sample at. Using the ``dwl`` values, we also calculate an effective sampling resolution, which is used to resample the spectra. Feeding both of these, we compute the flux of the spectrum at each pixel position. This computation is not described in this function, but in a separate location in the documentation.
-        
-        After computing the flux at each pixel, we save the ``x,y`` indicies of each pixel, the flux for that pixel, the wavelength of that pixel, and the shape and corner of the subimage for later use.
-        
+        Using the ``dwl`` values, we also calculate the wavelength covered by each pixel, and an effective sampling resolution, which is used to resample the spectra.
         
         **Variables which are used**:
         
@@ -457,19 +1283,17 @@ class Lenslet(ImageStack):
         
         :var txs: x-subimage-indicies of each illuminated oversampled pixel in o-px
         :var tys: y-subimage-indicies of each illuminated oversampled pixel in o-px
-        :var tfl: flux of each pixel in counts
         :var twl: wavelength of each pixel in meters
         :var tdw: delta wavelength covered by each pixel in meters
         :var trs: sampling resolution of each pixel
         :var subshape: shape of subimage to contain spectrum
         :var subcorner: corner of subimage to contain spectrum in px
-        :var spectrum: the spectrum object used for flux
-        :var traced: bool True
+        :var geometry: bool True
         
         """
         
-        if self.traced:
-            return self.traced
+        if self.geometry:
+            return self.geometry
             
         # Variables taken from the dispersion calculation
         points = np.array([self.dxs,self.dys]).T
@@ -530,33 +1354,70 @@ class Lenslet(ImageStack):
         WLS = WLS[:-1]
         RS = WLS/DWL
         
+        self.txs = x
+        self.tys = y
+        self.twl = WLS
+        self.tdw = DWL
+        self.trs = RS
+        self.subshape = (xsize,ysize)
+        self.subcorner = corner
+        self.geometry = True
+        
+        return self.geometry
+        
+    @_timed("trace")
+    def get_trace(self,spectrum):
+        """Returns a trace of this spectrum. The trace will contain x and y over-dense pixel positions, flux values for each of those illuminated pixels, instantaneous resolution at each pixel, and wavelength of each pixel. The trace also determines the corners of the spectrum, and saves those corner positions with ample padding in the image.
+        
+        The positions, wavelengths and resolutions of the pixels, and the subimage shape and corner, are found by :meth:`trace_geometry`, unless they have already been found (or loaded from a cache).
+        
+        We are then ready to extract flux values from our spectrum. This is done using the ``twl`` values as the wavelength values to sample at, along with the effective sampling resolution ``trs``, which is used to resample the spectra. Feeding both of these, we compute the flux of the spectrum at each pixel position. This computation is not described in this function, but in a separate location in the documentation.
+        
+        After computing the flux at each pixel, we save the flux for that pixel, and the spectrum, for later use.
+        
+        
+        **Variables which are used**:
+        
+        :var dxs: x-camera-positions of each illuminated oversampled pixel in px
+        :var dys: y-camera-positions of each illuminated oversampled pixel in px
+        :var dwl: wavelength of each illuminated oversampled pixel in meters
+        
+        **Variables which are set**:
+        
+        See :meth:`trace_geometry`, and
+        
+        :var tfl: flux of each pixel in counts
+        :var spectrum: the spectrum object used for flux
+        :var traced: bool True
+        
+        """
+        if self.traced:
+            return self.traced
+        
+        self.trace_geometry()
+        WLS = self.twl
+        RS = self.trs
         
         # Call and evaluate the spectrum
         self.log.debug(npArrayInfo(WLS,"Calling Wavelength"))
         self.log.debug(npArrayInfo(RS,"Calling Resolution"))
-
         wl,flux = spectrum(wavelengths=WLS,resolution=RS) 
                 
         self.log.debug(npArrayInfo(flux,"Final Flux"))
         self.log.debug(npArrayInfo(RS,"Saving Resolution"))
         
-        self.txs = x
-        self.tys = y
         self.tfl = flux
-        self.twl = WLS
-        self.tdw = DWL
-        self.trs = RS
-        self.subshape = (xsize,ysize)
-        self.subcorner = corner
         self.spectrum = spectrum
         self.traced = True
+        self.counters["points"] = len(flux)
         
         return self.traced
         
+    @_timed("place")
     def place_trace(self,get_conv):
         """Place the trace on the subimage.
         
-        First a blank image is created using the ``subshape`` variable as a template. Then, iterating through each point, we get the convolved PSF and telescope image for that point (called the "convolution"). The convolution can vary by wavelenght, and can have other variables which are sytem dependent. The convolution is multiplied by the flux value for that point. The corner of the convolution is then calculated (the top-left and bottom right corners are actually calculated) so that the image can be insterted as a 'flattened' array. Each image is inserted by addition, adding on to the image already in place.
+        First a blank image is created using the ``subshape`` variable as a template. Then, the trace points are grouped by the convolved PSF and telescope image that they use (called the "convolution"). The convolution can vary by wavelenght, and can have other variables which are sytem dependent. Points share a convolution when they share a key from :func:`SEDMachine.Kernels.kernel_keys`. For each group, the convolution is requested once, and every point in the group is deposited into the image with a single scatter-add of the convolution multiplied by the flux value for that point. Each convolution is centered on its point as if it were inserted into the slice from the top-left corner to the bottom-right corner of the convolution, adding on to the image already in place.
         
         **Variables which are used**:
         
@@ -573,20 +1434,20 @@ class Lenslet(ImageStack):
         
         """
         
-        img = np.zeros(self.subshape)
+        img = np.zeros(self.subshape,dtype=self.config["Precision"]["subimage"])
         
-        for x,y,wl,flux in zip(self.txs,self.tys,self.twl,self.tfl):
-            if self.config["Instrument"]["Tel"]["ellipse"]:
-                a = self.fa(wl)
-                b = self.fb(wl)
-                rot = self.falpha(wl)
-                conv = get_conv(wl,a,b,rot)
-            else:
-                conv = get_conv(wl)
-            tiny_image = conv * flux
-            tl_corner = [ x - tiny_image.shape[0]/2.0, y - tiny_image.shape[0]/2.0 ]
-            br_corner = [ x + tiny_image.shape[0]/2.0, y + tiny_image.shape[0]/2.0 ]
-            img[tl_corner[0]:br_corner[0],tl_corner[1]:br_corner[1]] += tiny_image
+        xs = np.asarray(self.txs)
+        ys = np.asarray(self.tys)
+        fluxes = np.asarray(self.tfl)
+        
+        # Kernel cache counters, when get_conv is a method of a ConvolutionKernels object
+        kernels = getattr(get_conv,"__self__",None)
+        hits, misses = getattr(kernels,"hits",0), getattr(kernels,"misses",0)
+        for group,conv in self._convolutions(get_conv):
+            self._deposit(img,conv,xs[group],ys[group],fluxes[group])
+        self.counters["kernel_hits"] = getattr(kernels,"hits",0) - hits
+        self.counters["kernel_misses"] = getattr(kernels,"misses",0) - misses
+        self.counters["subimage"] = img.size
         self.log.debug(npArrayInfo(img,"DenseSubImage"))
         self["Raw Spectrum"] = img
         frame = self.frame()
@@ -594,30 +1455,142 @@ class Lenslet(ImageStack):
         frame.corner = self.subcorner
         frame.configHash = hash(str(self.config.extract()))
     
-    def write_subimage(self):
-        """Writes a subimage to file and then clears the subimage from this lenslet's memory. The subimage is written to a file with a name formatted as ``%(Caches)s/Subimage-%(num)4d.fits`` where the fields to the format string are relatively self explanatory.
+    def response(self,get_conv):
+        """Return the linear response of the detector image to the flux of each trace point, as a sparse matrix. The response follows :meth:`place_trace`, :meth:`bin_subimage` and the placement of the binned subimage at ``subcorner``, so that the master image contribution of this lenslet is ``response.dot(tfl)``, reshaped to the detector shape.
+        
+        The matrix has one row for each pixel of the detector (``Instrument.image.size.px`` square, flattened) and one column for each trace point.
+        
+        :param get_conv: Function which returns the convolution kernel, see :meth:`place_trace`
+        :returns: :class:`scipy.sparse.csc_matrix`
+        
+        """
+        xs = np.asarray(self.txs)
+        ys = np.asarray(self.tys)
+        factor = self.config["Instrument"]["density"]
+        size = self.config["Instrument"]["image"]["size"]["px"]
+        binned = (self.subshape[0] // factor, self.subshape[1] // factor)
+        corner = np.asarray(self.subcorner).astype(np.int)
+        if np.any(corner < 0) or corner[0] + binned[0] > size or corner[1] + binned[1] > size:
+            raise SEDLimits
+        rows, cols, values = [], [], []
+        for group,conv in self._convolutions(get_conv):
+            nx, ny = conv.shape[0], conv.shape[0]
+            kx, ky = [ k.ravel() for k in np.mgrid[0:nx,0:ny] ]
+            kv = conv[:nx,:ny].ravel()
+            xstart, ystart = self._kernel_starts(self.subshape,conv,xs[group],ys[group])
+            px = xstart[:,np.newaxis] + kx[np.newaxis,:]
+            py = ystart[:,np.newaxis] + ky[np.newaxis,:]
+            bx, by, keep = self.bin_index(px,py,self.subshape,factor)
+            rows.append(((bx + corner[0]) * size + (by + corner[1]))[keep])
+            cols.append(np.repeat(group,kv.size).reshape(px.shape)[keep])
+            values.append(np.tile(kv,(len(group),1))[keep])
+        if len(rows) == 0:
+            return sp.sparse.csc_matrix((size * size,len(xs)))
+        return sp.sparse.coo_matrix((np.concatenate(values),(np.concatenate(rows),np.concatenate(cols))),shape=(size * size,len(xs))).tocsc()
+    
+    def _convolutions(self,get_conv):
+        """Yield ``(group, convolution)`` for each group of trace points which share a convolution kernel. See :meth:`place_trace`."""
+        wls = np.asarray(self.twl)
+        if self.config["Instrument"]["Tel"]["ellipse"]:
+            a = self.fits("a",wls)
+            b = self.fits("b",wls)
+            rot = self.fits("alpha",wls)
+            groups = self._kernel_groups(kernel_keys(a,b,rot))
+        else:
+            groups = [np.arange(len(wls))]
+        
+        for group in groups:
+            first = group[0]
+            if self.config["Instrument"]["Tel"]["ellipse"]:
+                conv = get_conv(wls[first],a[first],b[first],rot[first])
+            else:
+                conv = get_conv(wls[first])
+            yield group, conv
+    
+    def _kernel_groups(self,keys):
+        """Group point indices by their kernel keys. Groups are returned in the order in which their first point appears, and the indices within each group are in their original order.
+        
+        :param keys: Integer array of shape ``(k,N)``
+        :returns: list of index arrays
+        
+        """
+        order = np.lexsort(keys[::-1])
+        breaks = np.flatnonzero(np.any(np.diff(keys[:,order],axis=1) != 0,axis=0)) + 1
+        groups = np.split(order,breaks)
+        groups.sort(key=lambda group: group[0])
+        return groups
+    
+    def _deposit(self,img,kernel,xs,ys,fluxes,chunk=4096):
+        """Add ``kernel * flux`` into `img` at each point, using one scatter-add per chunk of points. Each scatter-add only covers the span of the image which the chunk touches, so the work follows the number of points rather than the image size. `img` must be C-contiguous, as it is written through a flat view.
+        
+        Each kernel is placed into the slice ``[x - n/2.0 : x + n/2.0]`` (truncated to integers) in each direction, where ``n`` is the kernel width. Points whose kernel would fall outside of the image raise :exc:`SEDLimits`.
         
-        Subimage writes will clobber old images.
         """
-        fileName = "%(Caches)s/Subimage-%(num)04d%(ext)s" % dict(num=self.num,ext=".fits",**self.config["Dirs"])
-        if os.access(fileName,os.F_OK):
-            os.remove(fileName)
-        self.write(fileName,primaryFrame="Raw Spectrum",clobber=True)
+        if not img.flags.c_contiguous:
+            raise ValueError("Image must be C-contiguous to deposit kernels into it.")
+        nx, ny = kernel.shape[0], kernel.shape[0]
+        xstart, ystart = self._kernel_starts(img.shape,kernel,xs,ys)
+        offsets = (np.arange(nx)[:,np.newaxis] * img.shape[1] + np.arange(ny)[np.newaxis,:]).ravel()
+        values = kernel[:nx,:ny].ravel()
+        flat = img.reshape(-1)
+        for i in xrange(0,len(xs),chunk):
+            corners = xstart[i:i+chunk] * img.shape[1] + ystart[i:i+chunk]
+            indices = (corners[:,np.newaxis] + offsets[np.newaxis,:]).ravel()
+            weights = (fluxes[i:i+chunk,np.newaxis] * values[np.newaxis,:]).ravel()
+            lo = indices.min()
+            sums = np.bincount(indices - lo,weights)
+            flat[lo:lo + sums.size] += sums
+    
+    def _kernel_starts(self,shape,kernel,xs,ys):
+        """Return the first x and y index of the slice of an image with the given shape which the kernel covers at each point. Points whose kernel would fall outside of the image raise :exc:`SEDLimits`. See :meth:`_deposit`."""
+        nx, ny = kernel.shape[0], kernel.shape[0]
+        xstart = np.floor(xs - nx/2.0).astype(np.int)
+        ystart = np.floor(ys - ny/2.0).astype(np.int)
+        if np.any(xstart < 0) or np.any(ystart < 0) or np.any(xstart + nx > shape[0]) or np.any(ystart + ny > shape[1]):
+            raise SEDLimits
+        return xstart, ystart
+    
+    @_timed("write")
+    def write_subimage(self,store):
+        """Writes the selected subimage, along with its lenslet number, corner and configuration hash, to a :class:`SubImageStore` and then clears the subimage from this lenslet's memory.
+        
+        :param store: :class:`SubImageStore` open for writing
+        
+        """
+        frame = self.frame()
+        store.write(self.num,frame(),frame.corner,frame.configHash)
         self.clear()
         
-    def read_subimage(self):
-        """Read a subimage from file and set the lenslet number and corner from data contained in the file. The filenames for subimages conform to the format ``%(Caches)s/Subimage-%(num)4d.fits``, similar to :meth:`write_subimage`. Frames are :class:`SubImage` classes so that they can safely store and retrieve their lenslet numbers and corner positions."""
-        self.read("%(Caches)s/Subimage-%(num)04d%(ext)s" % dict(num=self.num,ext=".fits",**self.config["Dirs"]))
+    @_timed("read")
+    def read_subimage(self,store):
+        """Read this lenslet's subimage from a :class:`SubImageStore` into a frame labeled "Raw Spectrum", and set the corner from the data in the store's index.
+        
+        :param store: :class:`SubImageStore` open for reading
+        
+        """
+        array, corner = store.read(self.num)
+        self["Raw Spectrum"] = array
         frame = self.frame()
-        self.num = frame.lensletNumber
-        self.subcorner = frame.corner
+        frame.lensletNumber = self.num
+        frame.corner = corner
+        self.subcorner = corner
         
+    @_timed("bin")
     def bin_subimage(self):
-        """Bin the selected subimage using the :meth:`bin` function, and binning based on the configured density. This function also sets the final data type as ``np.int16``.
+        """Bin the selected subimage using the :meth:`bin` function, and binning based on the configured density. The binned subimage is summed into a new float (double precision) array, whatever the data type of the subimage (``Precision.subimage``).
         
         """
         self["Binned Spectrum"] = self.bin(self.data(),self.config["Instrument"]["density"])
     
+    @_timed("bin")
+    def merge_subimage(self,accumulator):
+        """Bin the selected subimage, as :meth:`bin_subimage`, and add it into a :class:`DetectorAccumulator` at ``subcorner``, without making a frame for the binned subimage.
+        
+        :param accumulator: :class:`DetectorAccumulator` for the master image
+        
+        """
+        accumulator.add_binned(self.data(),self.config["Instrument"]["density"],self.subcorner)
+    
     def plot_raw_data(self):
         """Save a plot figure for raw-data from the lenslet.
         
@@ -662,7 +1635,7 @@ class Lenslet(ImageStack):
         plt.legend()
         plt.savefig("%(Partials)s/Lenslet-%(num)04d-WL-dy%(ext)s" % dict(num=self.num, ext=self.config["Plots"]["format"],**self.config["Dirs"]))
         plt.clf()
-        plt.plot(self.ls*1e6,self.fa(self.ls),".",linestyle='-')
+        plt.plot(self.ls*1e6,self.fits("a",self.ls),".",linestyle='-')
         plt.title("$\lambda$ along y-axis (%d)" % self.num)
         plt.xlabel("Wavelength ($\mu m$)")
         plt.ylabel("Major-Axis ($px$)")
@@ -676,7 +1649,7 @@ class Lenslet(ImageStack):
 
     def plot_rotation(self):
         """docstring for plot_ellipses"""
-        plt.plot(self.ls*1e6,self.falpha(self.ls) * 180.0 / np.pi,".",linestyle='-',label="YA")
+        plt.plot(self.ls*1e6,self.fits("alpha",self.ls) * 180.0 / np.pi,".",linestyle='-',label="YA")
                 
         
     def plot_dispersion(self):
@@ -772,23 +1745,30 @@ class Lenslet(ImageStack):
         plt.savefig("%(Partials)s/Instrument-%(num)04d-Resolution%(ext)s" % dict(num=self.num, ext=self.config["Plots"]["format"],**self.config["Dirs"]))
         plt.clf()
     
-    def bin(self,array,factor):
-        """Bins an array by the given factor in both directions.
+    def bin(self,array,factor,out=None):
+        """Bins an array by the given factor in both directions, summing each `factor` by `factor` block. Rows and columns beyond the last whole block are dropped. See :func:`block_bin`.
         
         :param array: array to be binned
         :param factor: binning factor
+        :param out: array to hold the result, or None
         :returns: array binned
         
         """
+        return block_bin(array,factor,out)
+        
     
-        finalShape = tuple((np.array(array.shape) / factor).astype(np.int))
-        Aout = np.zeros(finalShape)
-    
-        for i in range(factor):
-            Ai = array[i::factor,i::factor]
-            Aout += Ai
-    
-        return Aout
+    def bin_index(self,xs,ys,shape,factor):
+        """Return the position in the binned array of each position in an array binned by :meth:`bin`.
+        
+        :param xs: x positions in the array to be binned
+        :param ys: y positions in the array to be binned
+        :param shape: shape of the array to be binned
+        :param factor: binning factor
+        :returns: ``(xs, ys, keep)``, binned positions and a mask of the positions which are included in the binned array
+        
+        """
+        keep = (xs // factor < shape[0] // factor) & (ys // factor < shape[1] // factor)
+        return xs // factor, ys // factor, keep
         
     
     def rotate(self,point,angle,origin=None):
@@ -830,29 +1810,24 @@ class Lenslet(ImageStack):
         plt.fill(x, y, color=color, aa=True) 
         plt.plot(x, y, color='#666666', aa=True, lw=0.25)
     
-    def setup_crosstalk(self,n):
-        """Set up the crosstalk matrix for this lenslet and the flat base spectrum for this lenselt. This setup depends on the intended size of the crosstalk matrix.
-        
-        :param n: Size of the crosstalk matrix (number of source pixels)"""
-        self.pixelValues = np.zeros((n))
-    
     def find_crosstalk(self,pixel):
         """Find the crosstalk overlap with a given pixel. The crosstalk is defined as the fraction of that pixels light which will end up in this lenslet.
         
         :param pixel: The pixel for calculation. :class:`SourcePixel`
+        :returns: The overlap fraction
         
-        If the two shapes are disjoint, nothing is done. If they are not, we calculate the percentage of the pixel which ends up in this hexagon. This overlap factor is then saved in the crosstalk matrix for both the pixel and the lenslet. Finally, the pixel is scaled by the overlap and added to this lenslet's spectrum."""
+        If the two shapes are disjoint, the overlap is zero. If they are not, we calculate the fraction of the pixel which ends up in this hexagon. Neither the lenslet nor the pixel is changed, the overlaps are collected into a crosstalk matrix by the simulator."""
         if self.shape.disjoint(pixel.shape):
-            return
-        overlap = (self.shape.intersection(pixel.shape).area) / pixel.shape.area
-        self.spectrum += pixel * overlap
-        self.pixelValues[pixel.idx] = overlap
-        pixel.pixelValues[self.idx] = overlap
+            return 0.0
+        return (self.shape.intersection(pixel.shape).area) / pixel.shape.area
+        
+    def add_crosstalk(self,pixels,overlaps):
+        """Add the given pixels, each scaled by its overlap, to this lenslet's spectrum.
         
-    def find_normalized_overlap(self):
-        """Saves a normalized overlap matrix. The normalized overlap matrix is required for requesting colors from the color-map for matrix plotting."""
-        matrix = self.pixelValues
-        self.Norm_overlaps = Normalize(matrix)
+        :param pixels: The overlapping :class:`SourcePixel` objects
+        :param overlaps: The overlap fraction for each pixel"""
+        for pixel,overlap in zip(pixels,overlaps):
+            self.spectrum += pixel * overlap
 
         
 class SourcePixel(InterpolatedSpectrum):
@@ -893,12 +1868,55 @@ class SourcePixel(InterpolatedSpectrum):
         plt.fill(x, y, color=color, aa=True) 
         plt.plot(x, y, color='#666600', aa=True, lw=0.25)
         
-    def setup_crosstalk(self,n):
-        """docstring for setup_crosstalk"""
-        self.pixelValues = np.zeros((n))
-            
-    def get_color(self,idx):
-        """docstring for get_color"""
-        self.vals = Normalize()(self.pixelValues)
-        return cm.jet(self.vals[idx])
+    def get_color(self,overlaps,idx):
+        """Return the colormap color for lenslet `idx`, normalized over this pixel's `overlaps` (a dense column of the crosstalk matrix)."""
+        return cm.jet(Normalize()(overlaps)[idx])
     
+
+class ShapeGrid(object):
+    """A uniform grid index of shapely shapes, used to find the shapes which might overlap another shape without testing every shape.
+    
+    Each shape is entered into every grid cell touched by its bounding box. A query returns the shapes in the cells touched by the query bounding box whose own bounding boxes overlap the query bounding box.
+    
+    :param shapes: List of shapely shapes
+    :param size: Grid cell size. Defaults to the largest width or height of any shape.
+    
+    """
+    def __init__(self, shapes, size=None):
+        super(ShapeGrid, self).__init__()
+        self.bounds = np.array([shape.bounds for shape in shapes],dtype=np.float).reshape((-1,4))
+        if size is None:
+            extents = np.concatenate([self.bounds[:,2] - self.bounds[:,0],self.bounds[:,3] - self.bounds[:,1],[0.0]])
+            size = np.max(extents)
+        if size <= 0:
+            size = 1.0
+        self.size = float(size)
+        self.cells = collections.defaultdict(list)
+        for i,(lx,ly,hx,hy) in enumerate(self._cells(self.bounds)):
+            for cx in xrange(lx,hx+1):
+                for cy in xrange(ly,hy+1):
+                    self.cells[(cx,cy)].append(i)
+    
+    def _cells(self,bounds):
+        """Return the range of grid cells touched by each bounding box as ``(lx,ly,hx,hy)``"""
+        return np.floor(np.asarray(bounds) / self.size).astype(np.int)
+    
+    def query(self,bounds):
+        """Return the (sorted) indices of shapes whose bounding boxes overlap the given bounding box.
+        
+        :param bounds: ``(minx,miny,maxx,maxy)``, as given by ``shape.bounds``
+        :returns: Array of shape indices
+        
+        """
+        lx,ly,hx,hy = self._cells(bounds)
+        found = set()
+        for cx in xrange(lx,hx+1):
+            for cy in xrange(ly,hy+1):
+                found.update(self.cells.get((cx,cy),[]))
+        candidates = np.array(sorted(found),dtype=np.int)
+        if len(candidates) == 0:
+            return candidates
+        minx,miny,maxx,maxy = bounds
+        b = self.bounds[candidates]
+        overlaps = (b[:,0] <= maxx) & (b[:,2] >= minx) & (b[:,1] <= maxy) & (b[:,3] >= miny)
+        return candidates[overlaps]
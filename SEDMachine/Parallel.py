@@ -0,0 +1,145 @@
+#
+#  Parallel.py
+#  Process-pool execution of per-lenslet work for the SED Machine simulator.
+#  SED
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#  Version 0.3.9-p4
+#
+
+import multiprocessing
+import traceback
+import collections
+
+from AstroObject.AstroConfig import StructuredConfiguration
+
+from Objects import Lenslet, SubImageStore, DetectorShard
+
+__all__ = ["LensletPool","LensletTask","DISPERSION","PLACE","PLACE_MERGE","MERGE","RESPONSE"]
+
+LensletTask = collections.namedtuple("LensletTask","function inputs outputs kernels")
+
+# State held by each worker process. This is set once per worker by :func:`_initialize_worker`
+# so that the configuration and kernels are not re-sent with every lenslet.
+_worker = {}
+
+def _initialize_worker(config,kernels):
+    """Set up the per-process configuration and kernels. Each worker fills its own kernel cache, starting empty (see :class:`LensletPool`)."""
+    _worker["config"] = StructuredConfiguration(config)
+    _worker["kernels"] = kernels
+
+def _run_task(task):
+    """Rebuild a lenslet from the shipped attributes, run the task function on it, and return the requested attributes. Errors are returned as a formatted traceback so that the parent process can report them."""
+    num, function, state, outputs = task
+    try:
+        lenslet = Lenslet.from_state(state,_worker["config"])
+        function(lenslet)
+        return num, lenslet.export_state(outputs), None
+    except Exception:
+        return num, None, traceback.format_exc()
+
+def _run_shard(task):
+    """Run a task which leaves a subimage selected on each lenslet of a shard, in order, binning and adding the subimages into one :class:`DetectorShard` with :meth:`Lenslet.merge_subimage`. Returns the shard index, the shard, and a ``(num, state, error)`` tuple for each lenslet, as :func:`_run_task`. Failed lenslets are not added to the shard."""
+    index, function, states, outputs, shape, bounds = task
+    shard = DetectorShard(shape,_worker["config"]["Precision"]["accumulator"],bounds)
+    results = []
+    for num,state in states:
+        try:
+            lenslet = Lenslet.from_state(state,_worker["config"])
+            function(lenslet)
+            lenslet.merge_subimage(shard)
+            lenslet.clear(delete=True)
+            results.append((num,lenslet.export_state(outputs),None))
+        except Exception:
+            results.append((num,None,traceback.format_exc()))
+    return index, shard, results
+
+def find_dispersion(lenslet):
+    """Worker: calculate the dispersion and trace geometry for a lenslet."""
+    lenslet.find_dispersion()
+    lenslet.trace_geometry()
+
+def _subimages():
+    """Return this worker's read-only :class:`SubImageStore`, opening it on first use."""
+    if "subimages" not in _worker:
+        _worker["subimages"] = SubImageStore(_worker["config"]["Caches"]["Subimages"],_worker["config"]["Precision"]["subimage"]).open("r")
+    return _worker["subimages"]
+
+def place_trace(lenslet):
+    """Worker: place the trace for a lenslet, leaving the subimage in ``subimage``. Subimages are written to the store by the parent process."""
+    lenslet.place_trace(_worker["kernels"].get_conv)
+    lenslet.subimage = lenslet.data()
+    lenslet.clear(delete=True)
+
+def place_subimage(lenslet):
+    """Worker: place the trace for a lenslet, leaving the subimage selected to be merged by :func:`_run_shard`."""
+    lenslet.place_trace(_worker["kernels"].get_conv)
+
+def read_subimage(lenslet):
+    """Worker: read a cached subimage, leaving it selected to be merged by :func:`_run_shard`."""
+    lenslet.read_subimage(_subimages())
+
+def find_response(lenslet):
+    """Worker: find the response operator for a lenslet, leaving it in ``responseMatrix``."""
+    lenslet.responseMatrix = lenslet.response(_worker["kernels"].get_conv)
+
+DISPERSION = LensletTask(find_dispersion,
+    inputs=("xcs","ycs","xas","yas","xbs","ybs","ls","xpixs","ypixs","checked","passed","dispersion","geometry","fits","counters"),
+    outputs=("dxs","dys","dwl","drs","dis","dispersion","fits","txs","tys","twl","tdw","trs","subshape","subcorner","geometry","counters"),
+    kernels=False)
+
+PLACE = LensletTask(place_trace,
+    inputs=("txs","tys","twl","tfl","subshape","subcorner","fits","counters"),
+    outputs=("subimage","subcorner","counters"),
+    kernels=True)
+
+PLACE_MERGE = LensletTask(place_subimage,
+    inputs=PLACE.inputs,
+    outputs=("counters",),
+    kernels=True)
+
+MERGE = LensletTask(read_subimage,
+    inputs=("counters",),
+    outputs=("counters",),
+    kernels=False)
+
+RESPONSE = LensletTask(find_response,
+    inputs=("txs","tys","twl","subshape","subcorner","fits"),
+    outputs=("responseMatrix",),
+    kernels=True)
+
+class LensletPool(object):
+    """A pool of worker processes which run :class:`LensletTask` functions on lenslets.
+
+    Only the lenslet attributes named in the task's ``inputs`` are sent to the workers. The configuration (and kernels, if the task requires them) are sent once to each worker when the pool starts. Workers start with an empty kernel cache rather than a copy of this process's cache. Kernels depend only on their keys (see :class:`~SEDMachine.Kernels.ConvolutionKernels`), so a lenslet is placed the same way in any worker as in this process.
+
+    :param workers: Number of worker processes
+    :param config: Configuration dictionary
+    :param kernels: :class:`~SEDMachine.Kernels.ConvolutionKernels` object or None
+    :param chunksize: Number of lenslets sent to a worker at a time
+
+    """
+    def __init__(self, workers, config, kernels=None, chunksize=1):
+        super(LensletPool, self).__init__()
+        self.workers = workers
+        self.chunksize = chunksize
+        if kernels is not None:
+            kernels = kernels.empty()
+        self.pool = multiprocessing.Pool(workers,_initialize_worker,(config,kernels))
+
+    def imap(self,task,lenslets):
+        """Run the task on each lenslet, yielding ``(num, state, error)`` tuples as lenslets complete."""
+        tasks = ((lenslet.num,task.function,lenslet.export_state(task.inputs),task.outputs) for lenslet in lenslets)
+        return self.pool.imap_unordered(_run_task,tasks,self.chunksize)
+
+    def imap_shards(self,task,shards,shape,bounds):
+        """Run a task which leaves a subimage selected (``PLACE_MERGE`` or ``MERGE``) on each lenslet of each shard (see :func:`~SEDMachine.Objects.shard_lenslets`), binning and adding the subimages of each shard into a :class:`~SEDMachine.Objects.DetectorShard` for a detector of the given `shape`, allocated with the shard's `bounds` (see :func:`~SEDMachine.Objects.shard_bounds`). Yields ``(index, shard, results)`` tuples as shards complete, where `results` are ``(num, state, error)`` tuples, as for :meth:`imap`."""
+        tasks = ((index,task.function,[ (lenslet.num,lenslet.export_state(task.inputs)) for lenslet in lenslets ],task.outputs,shape,bounds[index]) for index,lenslets in enumerate(shards))
+        return self.pool.imap_unordered(_run_shard,tasks,1)
+
+    def close(self):
+        """Close the pool and wait for the worker processes to exit."""
+        self.pool.close()
+        self.pool.join()
+
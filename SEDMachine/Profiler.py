@@ -0,0 +1,139 @@
+#
+#  Profiler.py
+#  Timing and memory instrumentation for simulator stages and per-lenslet maps.
+#  SED
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#  Version 0.3.9-p4
+#
+
+import os
+import time
+import json
+import resource
+import functools
+import contextlib
+import collections
+import cProfile
+
+import numpy as np
+
+__all__ = ["StageProfiler","counter_summary","write_counters"]
+
+def _usage():
+    """Return the current wall time, CPU time for this process, CPU time for waited-for child processes (in seconds) and peak resident set size (in kB)."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.time(), own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, own.ru_maxrss
+
+class StageProfiler(object):
+    """Records the wall time, CPU time, peak RSS growth and call counts of simulator stages and per-lenslet maps.
+
+    Records are kept in the order in which they were first made, keyed by name. Maps are named after the stage they were run in and the function which was mapped, e.g. ``trace/<lambda>``. The CPU time of worker processes is recorded separately, as ``cpu_children``, once the workers have exited. The peak RSS growth is the increase in the peak resident set size of this process during each call, so it is zero for calls which did not use more memory than was already used earlier in the run.
+
+    When `directory` is set, each stage is also run under :mod:`cProfile`, and the statistics are dumped to ``<prefix>-<stage>.prof`` in that directory.
+
+    :param directory: Directory for :mod:`cProfile` dumps, or None
+    :param prefix: Filename prefix for :mod:`cProfile` dumps
+
+    """
+
+    fields = ("name","kind","calls","items","wall","cpu","cpu_children","rss")
+
+    def __init__(self, directory=None, prefix="profile"):
+        super(StageProfiler, self).__init__()
+        self.directory = directory
+        self.prefix = prefix
+        self.records = collections.OrderedDict()
+        self.stack = []
+
+    @property
+    def stage(self):
+        """The name of the stage currently running, or None"""
+        return self.stack[-1] if len(self.stack) > 0 else None
+
+    def _record(self,name,kind):
+        """Return the record for a name, creating it if required."""
+        if name not in self.records:
+            self.records[name] = dict(name=name,kind=kind,calls=0,items=0,wall=0.0,cpu=0.0,cpu_children=0.0,rss=0)
+        return self.records[name]
+
+    @contextlib.contextmanager
+    def measure(self,name,kind="stage",items=0):
+        """Context manager which adds the time and memory used by its block to the record for `name`."""
+        record = self._record(name,kind)
+        start = _usage()
+        try:
+            yield record
+        finally:
+            end = _usage()
+            record["calls"] += 1
+            record["items"] += items
+            record["wall"] += end[0] - start[0]
+            record["cpu"] += end[1] - start[1]
+            record["cpu_children"] += end[2] - start[2]
+            record["rss"] += end[3] - start[3]
+
+    def wrap(self,function,name):
+        """Return a version of a stage function which is measured (and profiled) under the given stage name. Attributes set by the stage decorators are copied to the returned function."""
+        @functools.wraps(function)
+        def stage(*args,**kwargs):
+            self.stack.append(name)
+            try:
+                with self.measure(name,"stage"):
+                    if self.directory is None:
+                        return function(*args,**kwargs)
+                    profile = cProfile.Profile()
+                    try:
+                        return profile.runcall(function,*args,**kwargs)
+                    finally:
+                        profile.dump_stats(os.path.join(self.directory,"%s-%s.prof" % (self.prefix,name)))
+            finally:
+                self.stack.pop()
+        return stage
+
+    def map(self,function,items):
+        """Context manager which measures a map of `function` over `items` items, in the current stage."""
+        name = "%s/%s" % (self.stage,getattr(function,"__name__",repr(function)))
+        return self.measure(name,"map",items)
+
+    def write(self,filename):
+        """Write the records to ``<filename>.json`` and ``<filename>.csv``. Times are in seconds, and peak RSS growth is in kB."""
+        records = self.records.values()
+        with open(filename + ".json","w") as stream:
+            json.dump(records,stream,indent=2)
+        with open(filename + ".csv","w") as stream:
+            stream.write(",".join(self.fields) + "\n")
+            for record in records:
+                stream.write(",".join(str(record[field]) for field in self.fields) + "\n")
+
+def counter_summary(counters,percentiles=(50,90,99,100),worst=10):
+    """Summarize per-lenslet counters (see :class:`~SEDMachine.Objects.Lenslet`).
+
+    :param counters: Dictionary of counter dictionaries, keyed by lenslet number
+    :param percentiles: Percentiles to find for each counter
+    :param worst: Number of lenslets to list by total time
+    :returns: Dictionary with the ``percentiles`` of each counter (over the lenslets which have that counter), and the ``worst`` lenslet numbers with their total time in seconds, slowest first.
+
+    """
+    names = sorted(set(name for lenslet in counters.itervalues() for name in lenslet))
+    summary = dict(percentiles={},worst=[])
+    for name in names:
+        values = np.array([ lenslet[name] for lenslet in counters.itervalues() if name in lenslet ],dtype=np.float)
+        summary["percentiles"][name] = dict(("p%d" % p,float(v)) for p,v in zip(percentiles,np.percentile(values,percentiles)))
+    totals = [ (sum(value for key,value in lenslet.iteritems() if key.endswith("_time")),num) for num,lenslet in counters.iteritems() ]
+    summary["worst"] = [ dict(num=int(num),time=total) for total,num in sorted(totals,reverse=True)[:worst] ]
+    return summary
+
+def write_counters(filename,counters,**kwargs):
+    """Write per-lenslet counters to ``<filename>.csv``, with one row for each lenslet, and their :func:`counter_summary` to ``<filename>.json``. Keyword arguments are passed to :func:`counter_summary`. Returns the summary."""
+    names = sorted(set(name for lenslet in counters.itervalues() for name in lenslet))
+    with open(filename + ".csv","w") as stream:
+        stream.write(",".join(["num"] + names) + "\n")
+        for num in sorted(counters.keys()):
+            stream.write(",".join([str(num)] + [ str(counters[num].get(name,"")) for name in names ]) + "\n")
+    summary = counter_summary(counters,**kwargs)
+    with open(filename + ".json","w") as stream:
+        json.dump(summary,stream,indent=2)
+    return summary
@@ -17,6 +17,7 @@ import matplotlib.pyplot as plt
 
 import scipy.signal
 import scipy.interpolate
+import scipy.sparse
 import yaml
 
 import shapely as sh
@@ -27,6 +28,8 @@ import logging,logging.handlers
 import time
 import copy
 import collections
+import hashlib
+import multiprocessing
 import gc
 
 from pkg_resources import resource_filename
@@ -43,6 +46,9 @@ from AstroObject.util import npArrayInfo
 
 from version import version as versionstr
 from Objects import *
+from Kernels import *
+from Parallel import LensletPool, DISPERSION, PLACE, PLACE_MERGE, MERGE, RESPONSE
+from Profiler import StageProfiler, write_counters
 
 
 class SEDSimulator(Simulator,ImageStack):
@@ -50,12 +56,21 @@ class SEDSimulator(Simulator,ImageStack):
     
     This simulator is based on :class:`AstroObject.AstroSimulator.Simulator`. It is designed to run as a series of dependent stages. The simulator is first setup, with basic data structures created in the constructor, and then simulator stages registered in :meth:`setup_stages`."""
     def __init__(self):
+        # The profiler must exist before any stages are registered (see :meth:`registerStage`)
+        self.profiler = StageProfiler()
         super(SEDSimulator, self).__init__(name="SEDMachine",version=versionstr)
         self.debug = False
         self.mapping = False
         self.dataClasses = [SubImage]
         self.lenslets = {}
-        self.ellipses = {}
+        self.kernels = None
+        self.merged = False
+        self.subimages = None
+        self.accumulator = None
+        self.shards = []
+        self.response = None
+        self.scatter = None
+        self.source_stage = None
         self.qe = SpectraStack(dataClasses=[AnalyticSpectrum,SpectraFrame])
         self.qe.save(FlatSpectrum(0.0))
         self.spectra =  SpectraStack(dataClasses=[AnalyticSpectrum,SpectraFrame])
@@ -85,6 +100,11 @@ class SEDSimulator(Simulator,ImageStack):
         self.registerConfigOpts("N",{"Lenslets":{"start":1000,"number":500},"Debug":False,"Output":{"Label":"NFlag",},},help="Limit lenslets (500,start from 1000)")
         self.registerConfigOpts("A",{"Lenslets":{"start":2100,"number":1},"Debug":True,"Output":{"Label":"AFlag",},},help="Debug, Single lenslets (start from 2100)")
         self.registerConfigOpts("C",{"Lenslets":{"position":{"x":0.0,"y":0.0},"radius":0.01},"Debug":True,"Output":{"Label":"CFlag",},},help="Debug, Central Lenslets")
+        self.parser.add_argument("--workers",action="store",type=int,default=None,metavar="N",help="Run per-lenslet stages with N worker processes")
+        self.parser.add_argument("--cache-subimages",action="store_true",dest="cache_subimages",help="Write subimages to the cache for *cached-only runs")
+        self.parser.add_argument("--sweep",action="store",default=None,metavar="FILE",help="YAML file of Observation and Source overrides for *sweep")
+        self.parser.add_argument("--profile",action="store_true",help="Write a timing and memory report for each stage to the logs directory")
+        self.parser.add_argument("--profile-stages",action="store_true",dest="profile_stages",help="Dump cProfile statistics for each stage to the logs directory")
         
         # SETUP Stages
         self.registerStage(self.setup_caches,"setup-caches")
@@ -127,6 +147,8 @@ class SEDSimulator(Simulator,ImageStack):
         self.registerStage(self.lenslet_dispersion,"dispersion")
         self.registerStage(self.lenslet_trace,"trace")
         self.registerStage(self.lenslet_place,"place")
+        self.registerStage(self.lenslet_response,"response")
+        self.registerStage(self.response_merge,"response-merge")
         
         # Merge images back together
         self.registerStage(self.image_merge,"merge-cached")
@@ -138,6 +160,7 @@ class SEDSimulator(Simulator,ImageStack):
         self.registerStage(self.apply_noise,"add-noise")
         self.registerStage(self.transpose,"transpose")
         self.registerStage(self.save_file,"save")
+        self.registerStage(self.sweep,"sweep")
         
         # Alternative work macros
         self.registerStage(None,"cached-only",help="Use cached subimages to construct final image",description="Building image from caches",dependencies=["merge-cached","crop","add-noise","add-scatter","transpose","save"])
@@ -179,7 +202,51 @@ class SEDSimulator(Simulator,ImageStack):
         
         
         self.registerStage(None,"plot",help="Create all plots",description="Plotting everything",dependencies=["plot-lenslet-xy","plot-lenslets","plot-sky","plot-qe","plot-source","plot-p-geometry","plot-hexagons","plot-pixels","plot-spectrum-tests","plot-kernel"])
-        
+    
+    
+    @ignore
+    def registerStage(self,stage,name=None,*args,**kwargs):
+        """Register a stage, as :meth:`AstroObject.AstroSimulator.Simulator.registerStage`. Each stage function is wrapped so that its time and memory use are recorded by the :class:`~SEDMachine.Profiler.StageProfiler` in ``profiler``."""
+        if stage is not None:
+            stage = self.profiler.wrap(stage,name if name is not None else stage.__name__)
+        return super(SEDSimulator, self).registerStage(stage,name,*args,**kwargs)
+    
+    
+    @ignore
+    def run(self):
+        """Run the simulator. When ``Profile.report`` is set, the time and memory used by each stage and per-lenslet map are written to ``<Label>-profile-<date>.json`` and ``.csv`` in the logs directory at the end of the run, even if the run fails."""
+        try:
+            super(SEDSimulator, self).run()
+        finally:
+            if self.config["Profile.report"]:
+                self.write_profile()
+    
+    
+    @ignore
+    def write_profile(self):
+        """Write the profiler records, and the per-lenslet counters (see :class:`~SEDMachine.Objects.Lenslet`) with their percentiles, to the logs directory. The lenslets which took the longest are also logged. See :meth:`run`."""
+        values = dict(directory=self._profile_directory(),label=self.config["Output.Label"],date=time.strftime("%Y-%m-%dT%H%M%S"))
+        filename = "%(directory)s/%(label)s-profile-%(date)s" % values
+        self.profiler.write(filename)
+        self.log.info("Wrote profile %s.json" % filename)
+        counters = dict((lenslet.num,lenslet.counters) for lenslet in self.lenslets.values() if len(lenslet.counters) > 0)
+        if len(counters) == 0:
+            return
+        filename = "%(directory)s/%(label)s-lenslets-%(date)s" % values
+        summary = write_counters(filename,counters)
+        self.log.info("Wrote lenslet counters %s.csv" % filename)
+        for worst in summary["worst"]:
+            self.log.info("Lenslet %(num)d took %(time).3fs" % worst)
+    
+    
+    @ignore
+    def _profile_directory(self):
+        """Return the logs directory for profile reports, creating it if required."""
+        directory = self.config["Dirs.Logs"]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+    
     
     @description("Setting up Caches")
     def setup_caches(self):
@@ -221,7 +288,7 @@ class SEDSimulator(Simulator,ImageStack):
     
     
     @description("Setting up lenslets")
-    @depends("setup-config")
+    @depends("setup-config","setup-caches")
     def setup_lenslets(self):
        """This function loads data about lenslet positions, and thier dispersion through the prism. The data are original produced by ZEMAX. This function reads the Zeemax data directly and then cleans the data in certain ways, preparing it for use later in the system.
        
@@ -233,6 +300,7 @@ class SEDSimulator(Simulator,ImageStack):
        - Wavelenghts are converted to SI units (m) instead of microns
        - Center of the lenslet array is calculated
        - Lenslets are validated. See :meth:`SEDMachine.Lenslet.Lenslet.valid`.
+       - Lenslets are selected using the ``Lenslets`` configuration (``start``, ``number``, ``radius`` and ``position``), and only the selected lenslets are created.
         
        **Data expected from ZEMAX**:
        
@@ -255,80 +323,135 @@ class SEDSimulator(Simulator,ImageStack):
       
        """
        # Load Lenslet Specification File
-       self.log.debug("Opening filename %s" % self.config["Instrument.files.lenslets"])
-       ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs = np.genfromtxt(self.dir_filename("Data",self.config["Instrument.files.lenslets"]),skip_header=1,comments="#",unpack=True)
-       # This data describes the following:
-       # ix - Index (number)
-       # xps - Pupil position in the x-direction
-       # yps - Pupil position in the y-direction
-       # lams - wavelengths for this position
-       # xs - X position (in mm, offest from top right corner) of this wavelength
-       # ys - Y Position (in mm, offset from top right corner) of this wavelength
-        
-       # Correctly Type Lenslet Specification Data
-       ix = ix.astype(np.int) #Indicies should always be integers
-        
-       lams *= 1e-6 # Convert wavelength to SI units (m)
-        
-       # This simply generates a list of all of the lenslets
-       self.lensletIndex = np.unique(ix)
-        
+       ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs = self.load_rays()
+        
+       # Group the spots by lenslet. A stable sort keeps each lenslet's spots in thier original order.
+       order = np.argsort(ix,kind='mergesort')
+       ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs = [ arr[order] for arr in (ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs) ]
+       self.lensletIndex, starts = np.unique(ix,return_index=True)
+       ends = np.append(starts[1:],ix.size)
+       rays = (xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs)
+       
        # Determine the center of the whole system by finding the x position that is closest to 0,0 in pupil position
        cntix = np.argmin(xps**2 + yps**2)
        self.center = ((xcs[cntix] + (self.config["Instrument.image.size.mm"]/2))* self.config["Instrument.convert.mmtopx"], (ycs[cntix] + (self.config["Instrument.image.size.mm"]/2)) * self.config["Instrument.convert.mmtopx"])
        
-        
-       # Progress bar for lenslet creation and validation
-      
-       total = len(self.lensletIndex)
-       self._start_progress_bar(total,"green")
-        
-       # Variables for lenslet use
-       FileName = "%(Partials)s/%(name)s%(ext)s" % dict(name="Lenslets-raw",ext=".dat",**self.config["Dirs"])
-       with open(FileName,'w') as stream:
-           for idx in self.lensletIndex:
-               select = idx == ix
-               lenslet = Lenslet(xps[select],yps[select],lams[select],idx,xcs[select], ycs[select],xls[select], yls[select],  xas[select], yas[select], xbs[select], ybs[select], rs[select],self.config,self.Caches)
-               if lenslet.valid(strict=self.config["Instrument.Lenslets.strict"]):
-                   self.lenslets[idx] = lenslet
-                   stream.write(lenslet.introspect())
-               self.progress += 1
-               self.progressbar.update(self.progress)
-       self.lensletIndex = np.asarray(self.lenslets.keys())
+       # Validate all lenslets at once, so that only valid lenslets are created.
+       passed, distance = valid_lenslets(self.lensletIndex,starts,xcs,ycs,lams,self.config,strict=self.config["Instrument.Lenslets.strict"])
+       self.log.debug("%d of %d lenslets passed validation" % (np.sum(passed),passed.size))
+       
+       # Select the lenslets to simulate before any lenslets are created
+       select = self._select_lenslets(np.flatnonzero(passed),xps[starts],yps[starts])
+       
+       # Progress bar for lenslet creation
+       self._start_progress_bar(len(select),"green")
+       
+       for i in select:
+           self.lenslets[self.lensletIndex[i]] = self._make_lenslet(i,starts,ends,distance,rays)
+           self.progress += 1
+           self.progressbar.update(self.progress)
        self._end_progress_bar()
        
+       # Raw lenslet output
+       if self.config["Instrument.Lenslets.introspect"]:
+           FileName = "%(Partials)s/%(name)s%(ext)s" % dict(name="Lenslets-raw",ext=".dat",**self.config["Dirs"])
+           with open(FileName,'w') as stream:
+               for i in select:
+                   stream.write(self.lenslets[self.lensletIndex[i]].introspect())
        
-       # Central Lenslet Output
-       FileName = "%(Partials)s/%(name)s%(ext)s" % dict(name="center-raw",ext=".dat",**self.config["Dirs"])
-       with open(FileName,'w') as stream:
-           lenslet = self.lenslets[ix[cntix]]
-           stream.write(lenslet.introspect())
        
+       # Central Lenslet Output
+       cntlx = np.searchsorted(self.lensletIndex,ix[cntix])
+       if passed[cntlx]:
+           FileName = "%(Partials)s/%(name)s%(ext)s" % dict(name="center-raw",ext=".dat",**self.config["Dirs"])
+           with open(FileName,'w') as stream:
+               if ix[cntix] in self.lenslets:
+                   lenslet = self.lenslets[ix[cntix]]
+               else:
+                   lenslet = self._make_lenslet(cntlx,starts,ends,distance,rays)
+               stream.write(lenslet.introspect())
+       else:
+           self.log.debug("Central lenslet %d is not valid" % ix[cntix])
        
-       if "start" in self.config["Lenslets"]:
-           self.lensletIndex = self.lensletIndex[self.config["Lenslets.start"]:]
-       if "number" in self.config["Lenslets"]:
-           self.lensletIndex = self.lensletIndex[:self.config["Lenslets.number"]]
-       if "radius" in self.config["Lenslets"] and "position" in self.config["Lenslets"]:
-           xp,yp = self.config["Lenslets.position.x"],self.config["Lenslets.position.y"]
-           xps,yps = np.array([l.ps[0] for l in self.lenslets.values()]).T
-           distances = np.sqrt((xps-xp)**2.0 + (yps-yp)**2.0)
-           include = distances <= self.config["Lenslets.radius"]
-           self.lensletIndex = self.lensletIndex[include]
+       self.lensletIndex = self.lensletIndex[select]
        self.total = len(self.lensletIndex)
-       self.lenslets = {x:self.lenslets[x] for x in self.lensletIndex}
-       for ix,lx in enumerate(self.lenslets.values()):
-           lx.idx = ix
+       for idx,num in enumerate(self.lensletIndex):
+           self.lenslets[num].idx = idx
     
     
+    @ignore
+    def _select_lenslets(self,valid,xps,yps):
+        """Return the positions (in the sorted lenslet index) of the lenslets to simulate, applying ``Lenslets.start``, ``Lenslets.number`` and ``Lenslets.radius`` (around ``Lenslets.position``) to the valid lenslets. Pupil positions are given for every lenslet, from each lenslet's first spot, so that the radius selection is a single array operation."""
+        if "start" in self.config["Lenslets"]:
+            valid = valid[self.config["Lenslets.start"]:]
+        if "number" in self.config["Lenslets"]:
+            valid = valid[:self.config["Lenslets.number"]]
+        if "radius" in self.config["Lenslets"] and "position" in self.config["Lenslets"]:
+            xp,yp = self.config["Lenslets.position.x"],self.config["Lenslets.position.y"]
+            distances = np.sqrt((xps[valid]-xp)**2.0 + (yps[valid]-yp)**2.0)
+            valid = valid[distances <= self.config["Lenslets.radius"]]
+        return valid
+    
+    
+    @ignore
+    def _make_lenslet(self,i,starts,ends,distance,rays):
+        """Create the validated lenslet at position `i` in the sorted lenslet index from the grouped ray data (the columns from :meth:`load_rays`, after the index column)."""
+        select = slice(starts[i],ends[i])
+        xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs = [ arr[select] for arr in rays ]
+        lenslet = Lenslet(xps,yps,lams,self.lensletIndex[i],xcs,ycs,xls,yls,xas,yas,xbs,ybs,rs,self.config,self.Caches)
+        lenslet.checked = True
+        lenslet.passed = True
+        lenslet.distance = distance[i]
+        return lenslet
+    
+    
+    @ignore
+    def load_rays(self):
+        """Load the ZEMAX ray data (``Instrument.files.lenslets``), returning the columns used by :meth:`setup_lenslets`. Indexes are converted to integers, and wavelengths to SI units (m).
+        
+        Parsing the ZEMAX text file is slow, so the converted columns are saved in a binary ``.npz`` file (``Caches.Rays``) and re-used when the ray file has not changed. The cache records the path, size and modification time of the ray file it was made from. The cache is ignored when caches are cleared, and not written when caching is disabled."""
+        names = ("ix","xps","yps","lams","xcs","ycs","xls","yls","xas","yas","xbs","ybs","rs")
+        Filename = self.dir_filename("Data",self.config["Instrument.files.lenslets"])
+        stat = os.stat(Filename)
+        source = "%s:%d:%r" % (os.path.abspath(Filename),stat.st_size,stat.st_mtime)
+        self.raySource = source
+        CacheName = self.config["Caches.Rays"]
+        if not self.config["Options"].get("clear_cache",False):
+            cache = load_archive(CacheName,source=source)
+            if cache is not None:
+                self.log.debug("Loading ray data from cache %s" % CacheName)
+                return [cache[name] for name in names]
+        
+        self.log.debug("Opening filename %s" % self.config["Instrument.files.lenslets"])
+        columns = np.genfromtxt(Filename,skip_header=1,comments="#",unpack=True)
+        # This data describes the following:
+        # ix - Index (number)
+        # xps - Pupil position in the x-direction
+        # yps - Pupil position in the y-direction
+        # lams - wavelengths for this position
+        # xs - X position (in mm, offest from top right corner) of this wavelength
+        # ys - Y Position (in mm, offset from top right corner) of this wavelength
+        ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs = columns
+        
+        # Correctly Type Lenslet Specification Data
+        ix = ix.astype(np.int) #Indicies should always be integers
+        
+        lams *= 1e-6 # Convert wavelength to SI units (m)
+        
+        columns = [ix, xps, yps, lams, xcs, ycs, xls, yls, xas, yas, xbs, ybs, rs]
+        if self.config["Options"].get("cache",True):
+            save_atomic(CacheName,np.savez,source=np.array(source),**dict(zip(names,columns)))
+        return columns
+    
+
     @description("Creating blank frame")
     @depends("setup-config")
     def setup_blank(self):
-        """Establish a blank image of zeros in every position. The image is established as ``np.int32`` values.
+        """Establish a blank image of zeros in every position. The image has the accumulator data type, ``Precision.accumulator``.
         
         **Command Name:** ``*setup-blank``
         """
-        self["Blank"] = np.zeros((self.config["Instrument.image.size.px"],self.config["Instrument.image.size.px"])).astype(np.int32)
+        self["Blank"] = np.zeros((self.config["Instrument.image.size.px"],self.config["Instrument.image.size.px"]),dtype=self.config["Precision.accumulator"])
         
     
     @description("Creating blank frame with a single one")
@@ -339,7 +462,7 @@ class SEDSimulator(Simulator,ImageStack):
         
         **Command Name:** ``*setup-blank-d``
         """
-        blank = np.zeros((self.config["Instrument.image.size.px"],self.config["Instrument.image.size.px"])).astype(np.int32)
+        blank = np.zeros((self.config["Instrument.image.size.px"],self.config["Instrument.image.size.px"]),dtype=self.config["Precision.accumulator"])
         center = np.int(self.config["Instrument.image.size.px"]/2.0)
         blank[center,center] = 1.0
         self["Blank"] = blank
@@ -352,6 +475,7 @@ class SEDSimulator(Simulator,ImageStack):
         .. Warning::
             This method is not ready for use yet. It requires some concept of the wavelength data for a data-cube. Extracting the wavelength calibration may be non-trivial."""
         
+        self.source_stage = "setup_source"
         self.log.warning("Stage 'setup-source' not ready yet, doing nothing!")
         return
         
@@ -395,6 +519,7 @@ class SEDSimulator(Simulator,ImageStack):
         There is no amplification applied to the source. Sources are expected to be in cgs units during input.
             
         """        
+        self.source_stage = "setup_simple_source"
         WL,FL = np.genfromtxt(self.dir_filename("Data",self.config["Source.Filename"]),unpack=True,comments="#")
         FL /= self.const["hc"] / WL
         FL *= 1e10 #Spectrum was per Angstrom, should now be per Meter
@@ -596,12 +721,62 @@ class SEDSimulator(Simulator,ImageStack):
     @description("Performing geometric resample")
     @depends("setup-source-pixels","setup-hexagons","setup-lenslets")
     def geometric_resample(self):
-        """docstring for fname"""
+        """Resample the source pixels onto the lenslets. The overlap of each source pixel with each lenslet is found using :meth:`SEDMachine.Objects.Lenslet.find_crosstalk`.
+        
+        Only pairs of pixels and lenslets whose bounding boxes overlap are tested, using a :class:`~SEDMachine.Objects.ShapeGrid` of the lenslet hexagons. The overlaps are saved as a sparse (lenslet by pixel) matrix in ``crosstalk``, and the source pixels are then mixed into each lenslet's spectrum using that matrix.
+        
+        Each lenslet's spectrum is replaced, so the resample can be run again after the source changes. By default, each lenslet's spectrum is the sum of the overlapping pixel spectra, scaled by their overlap. When ``Source.Resample.batched`` is set, every source pixel is sampled once onto a common wavelength grid (with ``Source.Resample.resolution``), and the lenslet spectra are found with a single sparse matrix product. Each lenslet spectrum is then an interpolated spectrum on that grid, so evaluating it does not depend on the number of overlapping pixels."""
         n = len(self.SourcePixels)
         m = len(self.lenslets)
-        self.map_over_lenslets(lambda l:l.setup_crosstalk(n),color=False)
-        self.map_over_pixels(lambda p:p.setup_crosstalk(m),color=False)
-        self.map_over_lenslets(lambda l:self.map_over_pixels(lambda p:l.find_crosstalk(p),color=False),color="green")
+        self._resample_lenslets = self.lenslets.values()
+        self._resample_grid = ShapeGrid([l.shape for l in self._resample_lenslets])
+        self._resample_overlaps = ([],[],[])
+        self.map_over_pixels(self._pixel_crosstalk,color="green")
+        rows, cols, values = self._resample_overlaps
+        self.crosstalk = scipy.sparse.coo_matrix((values,(rows,cols)),shape=(m,n)).tocsr()
+        self.log.debug("Crosstalk matrix has %d non-zero overlaps for %d lenslets and %d pixels" % (self.crosstalk.nnz,m,n))
+        del self._resample_lenslets, self._resample_grid, self._resample_overlaps
+        for lenslet in self.lenslets.values():
+            lenslet.spectrum = FlatSpectrum(0.0)
+        if self.config["Source.Resample.batched"]:
+            WL, RS = self.get_resolution_spectrum(self.config["Instrument.wavelengths.min"],self.config["Instrument.wavelengths.max"],self.config["Source.Resample.resolution"])
+            FL = np.empty((n,WL.size))
+            for pixel in self.SourcePixels:
+                FL[pixel.idx] = pixel(wavelengths=WL,resolution=RS)[1]
+            self._resample_wavelengths = WL
+            self._resample_flux = self.crosstalk.dot(FL)
+            self.map_over_lenslets(self._lenslet_batched_resample,color="green")
+            del self._resample_wavelengths, self._resample_flux
+        else:
+            self.map_over_lenslets(self._lenslet_resample,color="green")
+        
+    
+    @ignore
+    def _lenslet_resample(self,lenslet):
+        """Add the overlapping source pixels to a single lenslet's spectrum, using its row of the crosstalk matrix."""
+        row = self.crosstalk.getrow(lenslet.idx)
+        lenslet.add_crosstalk([self.SourcePixels[i] for i in row.indices],row.data)
+        
+    
+    @ignore
+    def _lenslet_batched_resample(self,lenslet):
+        """Set a single lenslet's spectrum from its row of the batched resample flux."""
+        if self.crosstalk.indptr[lenslet.idx] == self.crosstalk.indptr[lenslet.idx+1]:
+            return
+        lenslet.spectrum = InterpolatedSpectrum(np.array([self._resample_wavelengths,self._resample_flux[lenslet.idx]]),"Lenslet %d Source" % lenslet.num,method="resolve_and_integrate")
+        
+    
+    @ignore
+    def _pixel_crosstalk(self,pixel):
+        """Find the crosstalk between a single source pixel and the lenslets which might overlap it"""
+        rows, cols, values = self._resample_overlaps
+        for i in self._resample_grid.query(pixel.shape.bounds):
+            lenslet = self._resample_lenslets[i]
+            overlap = lenslet.find_crosstalk(pixel)
+            if overlap > 0:
+                rows.append(lenslet.idx)
+                cols.append(pixel.idx)
+                values.append(overlap)
         
     
     @description("Setting up calibration source")
@@ -630,6 +805,7 @@ class SEDSimulator(Simulator,ImageStack):
     @replaces("setup-source","geometric-resample","setup-source-pixels","apply-sky","apply-atmosphere")
     def line_source(self):
         """Use the line spectrum only"""
+        self.source_stage = "line_source"
         self.config["Output.Label"] += "-cal-"
         self.replace_source(self.spectra.frame("Calibration Lamp"))
         
@@ -640,6 +816,7 @@ class SEDSimulator(Simulator,ImageStack):
     @replaces("setup-source","geometric-resample","setup-source-pixels")
     def sky_source(self):
         """Use the sky spectrum only"""
+        self.source_stage = "sky_source"
         self.config["Output.Label"] += "-sky-"
         self.replace_source(self.sky.frame())
 
@@ -665,6 +842,7 @@ class SEDSimulator(Simulator,ImageStack):
     @replaces("setup-source","geometric-resample","setup-source-pixels","apply-sky","apply-atmosphere")
     def flat_source(self):
         """Replace the default file-source with a flat spectrum"""
+        self.source_stage = "flat_source"
         self.config["Output.Label"] += "-flat-"
         self.replace_source(FlatSpectrum(self.config["Source.Flat.value"]))
         
@@ -673,8 +851,48 @@ class SEDSimulator(Simulator,ImageStack):
     @help("Calculate lenslet dispersion")
     @depends("setup-lenslets","setup-caches")
     def lenslet_dispersion(self):
-        """Calculate the dispersion for each lenslet"""
-        self.map_over_lenslets(lambda l: l.find_dispersion(),color="blue")
+        """Calculate the dispersion and trace geometry for each lenslet.
+        
+        The geometry depends only on the ray data and the instrument configuration, so it is saved in a :class:`~SEDMachine.Objects.LensletGeometryCache` (``Caches.Geometry``), keyed by the ray file and the instrument configuration values which the geometry uses. Lenslets found in the cache are not recalculated. For the remaining lenslets, the polynomial fits are made at once (see :class:`~SEDMachine.Objects.DispersionFits`), and then the dispersion and trace geometry are found for each lenslet."""
+        cache = LensletGeometryCache(self.config["Caches.Geometry"],self._geometry_key())
+        states = {} if self.config["Options"].get("clear_cache",False) else cache.load()
+        missing = []
+        for lenslet in self.lenslets.values():
+            if lenslet.num in states:
+                lenslet.import_state(states[lenslet.num])
+            else:
+                missing.append(lenslet)
+        self.log.debug("Loaded geometry for %d of %d lenslets from %s" % (len(self.lenslets) - len(missing),len(self.lenslets),cache.filename))
+        if len(missing) == 0:
+            return
+        fits = DispersionFits.fit(missing,self.config)
+        for lenslet in missing:
+            lenslet.fits = fits.row(lenslet.num)
+        if self.config["Parallel.workers"] > 1:
+            self.map_over_lenslets_in_pool(DISPERSION,color="blue",lenslets=missing)
+        else:
+            self.map_over_collection(self._lenslet_geometry,lambda l:l.num,missing,True,"blue")
+        if self.config["Options"].get("cache",True):
+            for lenslet in missing:
+                if lenslet.geometry:
+                    states[lenslet.num] = lenslet.export_state(cache.names)
+            cache.save(states)
+        
+    
+    @ignore
+    def _lenslet_geometry(self,lenslet):
+        """Find the dispersion and trace geometry for a single lenslet"""
+        lenslet.find_dispersion()
+        lenslet.trace_geometry()
+        
+    
+    @ignore
+    def _geometry_key(self):
+        """Return a key identifying the ray data and instrument configuration used by the lenslet geometry. See :meth:`lenslet_dispersion`."""
+        values = [ self.raySource ]
+        for name in ("density","dispfitorder","padding","Tel.dispfitorder","Tel.ellipse","convert.mmtopx","image.size.mm"):
+            values.append((name,self.config["Instrument." + name]))
+        return hashlib.md5(repr(values)).hexdigest()
         
     
     @description("Tracing lenslet spectra dispersion")
@@ -688,46 +906,200 @@ class SEDSimulator(Simulator,ImageStack):
     @include
     @description("Placing lenslet spectra")
     @help("Place subimages")
-    @depends("trace")
+    @depends("trace","setup-blank")
     def lenslet_place(self):
-        """Place each spectrum into the subimage"""
-        self.map_over_lenslets(self._lenslet_place,color="yellow")
+        """Place each spectrum into the subimage.
         
+        Unless ``Subimages.cache`` is set, each subimage is binned and merged into the master image (labeled "Merge") as soon as it is placed, and nothing is written to disk. When ``Subimages.cache`` is set, subimages are instead written to the cache, and merged by ``*merge-cached``, so that they can be re-used with ``*cached-only``."""
+        cache = self.config["Subimages.cache"]
+        if cache:
+            self.subimages = SubImageStore(self.config["Caches.Subimages"],self.config["Precision.subimage"]).open("w")
+        else:
+            self._start_merge()
+            shards = self._start_shards()
+        if self.config["Parallel.workers"] > 1:
+            if cache:
+                self.map_over_lenslets_in_pool(PLACE,color="yellow",collect=self._lenslet_write_placed)
+            else:
+                self.map_over_shards_in_pool(PLACE_MERGE,shards,color="yellow")
+        else:
+            lenslets = self.lenslets.values() if cache else [ lenslet for shard in shards for lenslet in shard ]
+            self.map_over_collection(self._lenslet_place,lambda l:l.num,lenslets,True,"yellow")
+        self.log.info(self._kernel_report())
+        if cache:
+            self.subimages.close()
+        else:
+            self.merged = True
+            self._finish_merge()
+        
+    
+    @ignore
+    def _kernel_report(self):
+        """Return a summary of the kernel cache counters. Worker processes each have their own kernel cache, so with ``Parallel.workers`` the kernel hits and misses recorded in each lenslet's counters (see :meth:`~SEDMachine.Objects.Lenslet.place_trace`) are summed instead."""
+        if self.config["Parallel.workers"] > 1:
+            hits = sum(lenslet.counters.get("kernel_hits",0) for lenslet in self.lenslets.values())
+            misses = sum(lenslet.counters.get("kernel_misses",0) for lenslet in self.lenslets.values())
+            return "Kernel cache (%d workers): %d hits, %d misses" % (self.config["Parallel.workers"],hits,misses)
+        return self.get_kernels().report()
     
     @ignore
     def _lenslet_place(self,l):
-        """docstring for _lenslet_place"""
-        l.place_trace(self.get_conv)
-        l.write_subimage()
+        """Place a single lenslet, and either cache its subimage or merge it into the master image"""
+        l.place_trace(self.get_kernels().get_conv)
+        if self.config["Subimages.cache"]:
+            l.write_subimage(self.subimages)
+        else:
+            self._lenslet_merge_placed(l)
+    
+    
+    @description("Finding the detector response")
+    @help("Find the linear response of the detector to each lenslet trace")
+    @depends("dispersion","setup-caches","setup-blank")
+    def lenslet_response(self):
+        """Find the linear response operator from the flux of each trace point to the detector image (see :class:`~SEDMachine.Objects.ResponseOperator`).
+        
+        The operator depends only on the lenslet geometry and the convolution kernels, so it is saved in ``Caches.Response``, keyed by those inputs. Lenslets already in the saved operator are not recalculated. Use ``*response-merge`` to make images from the operator."""
+        self.response = ResponseOperator(self.config["Caches.Response"],self._response_key(),(self.config["Instrument.image.size.px"],self.config["Instrument.image.size.px"]))
+        if not self.config["Options"].get("clear_cache",False):
+            self.response.load()
+        missing = [ lenslet for lenslet in self.lenslets.values() if lenslet.num not in self.response ]
+        self.log.debug("Response operator has %d of %d lenslets" % (len(self.lenslets) - len(missing),len(self.lenslets)))
+        if len(missing) == 0:
+            return
+        if self.config["Parallel.workers"] > 1:
+            self.map_over_lenslets_in_pool(RESPONSE,color="yellow",collect=self._lenslet_add_response,lenslets=missing)
+        else:
+            self.map_over_collection(self._lenslet_response,lambda l:l.num,missing,True,"yellow")
+        if self.config["Options"].get("cache",True):
+            self.response.save()
+        
     
+    @ignore
+    def _lenslet_response(self,lenslet):
+        """Find the response for a single lenslet and add it to the response operator"""
+        self.response.add(lenslet.num,lenslet.response(self.get_conv))
+    
+    @ignore
+    def _lenslet_add_response(self,lenslet):
+        """Add a lenslet's response, found by a worker process, to the response operator"""
+        self.response.add(lenslet.num,lenslet.responseMatrix)
+        del lenslet.responseMatrix
+    
+    @ignore
+    def _response_key(self):
+        """Return a key identifying the lenslet geometry, kernels and detector used by the response operator. See :meth:`lenslet_response`."""
+        kernels = self.get_kernels()
+        values = [ self._geometry_key(), kernels.identity, hashlib.md5(np.ascontiguousarray(kernels.conv).tostring()).hexdigest() ]
+        for name in ("image.size.px","density","Tel.ellipse"):
+            values.append((name,self.config["Instrument." + name]))
+        return hashlib.md5(repr(values)).hexdigest()
+    
+    
+    @description("Merging subimages with the response operator")
+    @help("Make the master image from the response operator, instead of placing subimages")
+    @depends("response","trace","setup-blank")
+    @replaces("place","merge-cached")
+    def response_merge(self):
+        """Make the master image (labeled "Merge") from the trace fluxes of every lenslet, using the response operator found by :meth:`lenslet_response`. This replaces placing, binning and merging each subimage."""
+        self._start_merge()
+        image = self.response.apply(dict((lenslet.num,lenslet.tfl) for lenslet in self.lenslets.values() if lenslet.num in self.response and lenslet.traced))
+        self.accumulator.add(image,(0,0))
+        self.merged = True
+        self._finish_merge()
+        
     
     @include
     @description("Merging subimages")
     @depends("setup-blank","setup-lenslets")
     def image_merge(self):
-        """Merge subimages into master image"""
-        self.select("Blank")
-        self.save(self.frame(),"Merge")
-        self.map_over_lenslets(self._lenslet_merge,color="yellow")
-        self.select("Merge")
+        """Merge subimages into master image. If the subimages were merged when they were placed (see :meth:`lenslet_place`), this only selects the master image."""
+        if self.merged:
+            self.select("Merge")
+            return
+        self._start_merge()
+        shards = self._start_shards()
+        self.subimages = SubImageStore(self.config["Caches.Subimages"],self.config["Precision.subimage"]).open("r")
+        if self.config["Parallel.workers"] > 1:
+            self.map_over_shards_in_pool(MERGE,shards,color="yellow")
+        else:
+            self.map_over_collection(self._lenslet_merge,lambda l:l.num,[ lenslet for shard in shards for lenslet in shard ],True,"yellow")
+        self.subimages.close()
+        self._finish_merge()
         
     
     
+    @ignore
+    def _lenslet_write_placed(self,lenslet):
+        """Write a lenslet's subimage, placed by a worker process, to the subimage store"""
+        self.subimages.write(lenslet.num,lenslet.subimage,lenslet.subcorner,hash(str(self.config.extract())))
+        del lenslet.subimage
+    
+    @ignore
+    def _start_merge(self):
+        """Start the master image from the blank image. Subimages are added into a :class:`~SEDMachine.Objects.DetectorAccumulator` in ``accumulator``, and the master image is saved by :meth:`_finish_merge`."""
+        self.accumulator = DetectorAccumulator(self.data("Blank"),self.config["Precision.accumulator"])
+        self.shards = []
+    
+    @ignore
+    def _start_shards(self):
+        """Split the lenslets into ``Parallel.shards`` groups with :func:`~SEDMachine.Objects.shard_lenslets`, and start an empty :class:`~SEDMachine.Objects.DetectorShard` for each group, allocated once to cover the binned subimages of the group (see :func:`~SEDMachine.Objects.shard_bounds`). Subimages are added to the shard of their lenslet, in the order of the group, whether they are merged in this process or in worker processes, and the shards are combined in a fixed order by :meth:`_finish_merge`, so the master image does not depend on ``Parallel.workers``. Returns the groups of lenslets."""
+        groups = shard_lenslets(self.lenslets.values(),self.config["Parallel.shards"])
+        shape = self.accumulator.data.shape
+        self.bounds = [ shard_bounds(group,self.config["Instrument.density"],shape) for group in groups ]
+        self.shards = [ DetectorShard(shape,self.config["Precision.accumulator"],bounds) for bounds in self.bounds ]
+        self.shardof = dict((lenslet.num,index) for index,group in enumerate(groups) for lenslet in group)
+        return groups
+    
+    @ignore
+    def _finish_merge(self):
+        """Combine the shards (see :func:`~SEDMachine.Objects.reduce_shards`) into the accumulated master image, then save it, labeled "Merge", and select it."""
+        shard = reduce_shards(self.shards)
+        if shard is not None and shard.data.size > 0:
+            self.accumulator.add(shard.data,shard.corner)
+        self.save(self.accumulator.data,"Merge",clobber=True)
+        self.accumulator = None
+        self.shards = []
+        self.select("Merge")
+        
+    
     @ignore
     def _lenslet_merge(self,lenslet):
         """Merge a single lenslet into the master image"""
-        lenslet.read_subimage()
-        lenslet.bin_subimage()
-        self.place(lenslet.data(),lenslet.subcorner)
+        lenslet.read_subimage(self.subimages)
+        self._lenslet_merge_placed(lenslet)
+    
+    @ignore
+    def _lenslet_merge_placed(self,lenslet):
+        """Bin the selected subimage of a lenslet and merge it into the master image"""
+        lenslet.merge_subimage(self.shards[self.shardof[lenslet.num]])
         lenslet.clear(delete=True)
     
     
     
     @description("Setting up scattered light calculations")
-    @depends("setup-config","setup-blank")
+    @depends("setup-config","setup-caches","setup-blank")
     def setup_scatter(self):
-        """Sets up scattered light level"""
+        """Sets up scattered light level.
         
+        When ``Instrument.Scatter.FFT`` is set, only the real FFT of the scattered light kernel is kept (see :class:`~SEDMachine.Objects.ScatterSpectrum`), padded for image tiles of the size given by :meth:`_scatter_tile`. The spectrum is saved in ``Caches.Scatter``, keyed by the scattered light kernels, so the kernel is only made when the spectrum is not already cached. Otherwise, the kernel is saved as the "Scatter" frame."""
+        ccd = self.config["Instrument.ccd.size.px"]
+        if self.config["Instrument.Scatter.FFT"]:
+            tile = min(self._scatter_tile() or ccd,ccd)
+            self.scatter = ScatterSpectrum(self.config["Caches.Scatter"],self._scatter_key(),(ccd+1,ccd+1),(tile,tile))
+            if not self.config["Options"].get("clear_cache",False) and self.scatter.load():
+                return
+            self.scatter.compute(self._scatter_kernel())
+            if self.config["Options"].get("cache",True):
+                self.scatter.save()
+        else:
+            state = self.framename
+            self.save(self._scatter_kernel(),"Scatter")
+            self.select(state)
+        
+    
+    @ignore
+    def _scatter_kernel(self):
+        """Return the scattered light kernel, the sum of the ``Instrument.Scatter.Kernels``."""
         area = np.zeros((self.config["Instrument.ccd.size.px"]+1,self.config["Instrument.ccd.size.px"]+1))
         
         size = self.config["Instrument.ccd.size.px"]/2
@@ -736,10 +1108,21 @@ class SEDSimulator(Simulator,ImageStack):
                 n = v["mag"] * self.gauss_kern(v["stdev"],size,enlarge=False,normalize=False)
                 self.log.debug(npArrayInfo(n,"Gauss Kernel"))
             area += n
-        
-        state = self.framename
-        self.save(area,"Scatter")        
-        self.select(state)
+        return area
+    
+    @ignore
+    def _scatter_tile(self):
+        """Return the tile size for the scattered light convolution, ``Instrument.Scatter.tile.px``, or 0 for a single tile. Tiles are never smaller than the scattered light kernel, as overlap-add with smaller tiles takes more FFT work than convolving the whole image."""
+        size = self.config["Instrument.Scatter.tile.px"]
+        if not size:
+            return 0
+        return max(int(size),self.config["Instrument.ccd.size.px"]+1)
+    
+    @ignore
+    def _scatter_key(self):
+        """Return a key identifying the scattered light kernel. See :meth:`setup_scatter`."""
+        values = [ ("ccd.size.px",self.config["Instrument.ccd.size.px"]), ("Scatter.Kernels",sorted(self.config["Instrument.Scatter.Kernels"].items())) ]
+        return hashlib.md5(repr(values)).hexdigest()
         
     
     
@@ -777,14 +1160,16 @@ class SEDSimulator(Simulator,ImageStack):
     @description("Adding Dark/Bias noise")
     @depends("crop","setup-noise")
     def apply_noise(self):
-        """Apply the noise masks to the target image label"""
+        """Apply the noise masks to the target image label. The masks are added one tile (``Instrument.tile.px``) at a time, so no full-size temporary image is made."""
         
         dark = self.data("Dark")
         bias = self.data("Read")
         
         data = self.data()
         
-        data += dark + bias
+        for tile in detector_tiles(data.shape,self.config["Instrument.tile.px"]):
+            data[tile] += dark[tile]
+            data[tile] += bias[tile]
         
         self.save(data,"Noisy",clobber=True)
     
@@ -794,27 +1179,30 @@ class SEDSimulator(Simulator,ImageStack):
     @description("Adding scatter noise")
     @depends("crop","setup-scatter")
     def apply_scatter(self):
-        """Apply the scattered light frame"""
-        
-        
-        scatter = self.data("Scatter")
-        
-        self.log.debug(npArrayInfo(scatter,"Scatter"))
-        
+        """Apply the scattered light frame. The image is convolved with the scattered light kernel one tile (see :meth:`_scatter_tile`) at a time, by overlap-add. By default, the whole image is a single tile. With ``Instrument.Scatter.FFT``, each tile is convolved with the cached kernel spectrum (see :meth:`setup_scatter`), using one forward and one inverse real FFT. Otherwise, each tile is convolved directly with :func:`~SEDMachine.Objects.tiled_convolve`. The scattered light is centered on the larger of the image and the kernel, as by :func:`scipy.signal.fftconvolve` in ``same`` mode, and cut to the shape of the image."""
         
         data = self.data()
         self.log.debug(npArrayInfo(data,"Data \'%s\'" % self.framename))
         
+        if self.config["Instrument.Scatter.FFT"]:
+            kernel = np.array(self.scatter.kernel)
+        else:
+            scatter = self.data("Scatter")
+            self.log.debug(npArrayInfo(scatter,"Scatter"))
+            kernel = np.array(scatter.shape)
         
+        full = np.array(data.shape) + kernel - 1
+        same = kernel if np.prod(kernel) > data.size else np.array(data.shape)
+        start = (full - same) // 2
         if self.config["Instrument.Scatter.FFT"]:
-            result = sp.signal.fftconvolve(data,scatter,mode='same')
+            result = self.scatter.convolve(data,self._scatter_tile(),start,data.shape,self.config["Precision.accumulator"])
         else:
-            result = sp.signal.convolve(data,scatter,mode='same')
+            result = tiled_convolve(data,scatter,self._scatter_tile(),start,data.shape,False,self.config["Precision.accumulator"])
         
         result *= self.config["Instrument.Scatter.Amplifier"]
         
         self.log.debug(npArrayInfo(result,"Scattered Light"))
-        end = data + result[:-1,:-1]
+        end = data + result
         
         self.save(result,"ScatterOnly")
         self.save(end,"Scattered",clobber=True)
@@ -826,10 +1214,13 @@ class SEDSimulator(Simulator,ImageStack):
     @description("Transposing Image")
     @depends("crop")
     def transpose(self):
-        """transpose the final image"""
+        """Transpose the final image, and convert it to the output data type, ``Precision.output``, with :func:`~SEDMachine.Objects.quantize`. When ``Precision.saturate`` is set, pixels outside the range of the output type are clipped, and the number of clipped pixels is logged."""
         data = self.data()
-
-        self.save(data.T.astype(np.int16),"Transposed",clobber=True)
+        
+        output, clipped = quantize(data.T,self.config["Precision.output"],self.config["Precision.saturate"])
+        if clipped > 0:
+            self.log.warning("%d pixels saturated in conversion to %s" % (clipped,self.config["Precision.output"]))
+        self.save(output,"Transposed",clobber=True)
         
     
     
@@ -847,6 +1238,101 @@ class SEDSimulator(Simulator,ImageStack):
         self.Filename = "%(Output)s/%(label)s-deep-%(date)s.%(fmt)s" % dict(label=self.config["Output.Label"],date=time.strftime("%Y-%m-%d"), fmt=self.config["Output.Format"], **self.config["Dirs"] )
         self.write(self.Filename,clobber=True)
         self.log.info("Wrote %s" % self.Filename)
+
+    
+    @help("Simulate each configuration in a sweep file")
+    @description("Simulating sweep configurations")
+    @depends("setup-lenslets","setup-hexagons","setup-blank","setup-cameras","setup-scatter","dispersion","geometric-resample")
+    @replaces("setup-sky","setup-noise","apply-sky","apply-qe","apply-atmosphere","trace","place","merge-cached","crop","add-noise","add-scatter","transpose","save")
+    def sweep(self):
+        """Simulate each of the ``Observation`` and ``Source`` configurations in the file given by ``--sweep`` (see :func:`~SEDMachine.Objects.sweep_configurations`), writing one image for each.
+    
+        The lenslets, dispersion, kernels and source resample (and the response operator, if ``*response`` is also run) are found once. Each configuration is then simulated from those in a forked process, which has its own copy of the lenslet spectra and configuration. Configurations which change the ``Source`` run the source stage again (see :meth:`_sweep_configuration`). Images are labeled with the ``Output.Label`` and the configuration number, and the overrides for each label are listed in ``<Label>-sweep.yaml`` in the output directory. Up to ``Parallel.workers`` configurations are simulated at once."""
+        filename = self.config["Options"].get("sweep",None)
+        if filename is None:
+            raise ValueError("No sweep file given, use '--sweep FILE'.")
+        with open(filename,"r") as stream:
+            configurations = sweep_configurations(yaml.load(stream))
+        if self.source_stage is None and any(name.startswith("Source.") for overrides in configurations for name in overrides):
+            raise ValueError("Sweep file %s changes the Source, but no source stage was run." % filename)
+        label = self.config["Output.Label"]
+        with open("%(Output)s/%(label)s-sweep.yaml" % dict(label=label,**self.config["Dirs"]),"w") as stream:
+            yaml.dump([ dict(Label=self._sweep_label(label,index),Overrides=overrides) for index,overrides in enumerate(configurations) ],stream,default_flow_style=False)
+        concurrent = max(1,min(self.config["Parallel.workers"],len(configurations)))
+        running = []
+        failed = []
+        for index,overrides in enumerate(configurations):
+            while len(running) >= concurrent:
+                self._sweep_wait(running,failed)
+            process = multiprocessing.Process(target=self._sweep_configuration,args=(index,overrides,concurrent > 1))
+            process.start()
+            running.append((index,process))
+        while len(running) > 0:
+            self._sweep_wait(running,failed)
+        if len(failed) > 0:
+            self.log.error("Sweep configurations %s failed" % ", ".join(self._sweep_label(label,index) for index in sorted(failed)))
+    
+    
+    @ignore
+    def _sweep_label(self,label,index):
+        """Return the output label for a sweep configuration"""
+        return "%s-%03d" % (label,index)
+    
+    @ignore
+    def _sweep_wait(self,running,failed):
+        """Wait for one of the running sweep processes to finish, and remove it from `running`. The numbers of failed configurations are added to `failed`."""
+        while True:
+            for index,process in running:
+                if not process.is_alive():
+                    process.join()
+                    running.remove((index,process))
+                    if process.exitcode != 0:
+                        failed.append(index)
+                    else:
+                        self.log.info("Finished sweep configuration %d" % index)
+                    return
+            time.sleep(0.1)
+    
+    @ignore
+    def _sweep_configuration(self,index,overrides,serial):
+        """Simulate a single sweep configuration. This runs in a forked process (see :meth:`sweep`), so the changes made here to the configuration and lenslets are not seen by other configurations. When `serial` is set, per-lenslet stages are run without worker processes, as the configurations themselves are already running concurrently. When `overrides` change the ``Source``, the source stage which the simulator ran is run again (for a source from pixels, followed by the source pixels and the resample, and for a calibration lamp, after the line list). The flat and calibration lamp sources do not have the sky and atmosphere applied, and the sky source is taken again from the sky for this configuration."""
+        label = self._sweep_label(self.config["Output.Label"],index)
+        for name,value in overrides.iteritems():
+            self.config[name] = value
+        self.config["Subimages.cache"] = False
+        if serial:
+            self.config["Parallel.workers"] = 1
+        pixels = self.source_stage in ("setup_source","setup_simple_source")
+        sky = self.source_stage not in ("flat_source","line_source")
+        if any(name.startswith("Source.") for name in overrides):
+            if self.source_stage == "line_source":
+                self.setup_line_list()
+            if self.source_stage != "sky_source":
+                getattr(self,self.source_stage)()
+            if pixels:
+                self.setup_source_pixels()
+                self.geometric_resample()
+        self.setup_sky()
+        self.setup_noise()
+        if sky:
+            self.apply_sky()
+        self.apply_qe()
+        if sky:
+            self.apply_atmosphere()
+        if self.source_stage == "sky_source":
+            self.sky_source()
+        self.config["Output.Label"] = label
+        self.lenslet_trace()
+        if self.response is not None:
+            self.response_merge()
+        else:
+            self.lenslet_place()
+        self.image_merge()
+        self.ccd_crop()
+        self.apply_scatter()
+        self.apply_noise()
+        self.transpose()
+        self.save_file()
     
     
     ################################
@@ -1337,7 +1823,8 @@ class SEDSimulator(Simulator,ImageStack):
         plt.clf()
         plt.title("Resample for pixel %g" % pixel.num)
         pixel.show_geometry()
-        self.map_over_lenslets(lambda l:self._show_lenslet_resample(l,pixel),color=False)
+        overlaps = self.crosstalk.getcol(pixel.idx).toarray().ravel()
+        self.map_over_lenslets(lambda l:self._show_lenslet_resample(l,pixel,overlaps),color=False)
         # plt.colorbar()
         
         FileName = "%(Partials)s/System-Geometry-%(pixel)g%(fmt)s" % dict(pixel=pixel.num,fmt=self.config["Plots.format"],**self.config["Dirs"])
@@ -1414,9 +1901,9 @@ class SEDSimulator(Simulator,ImageStack):
         
         
     @ignore
-    def _show_lenslet_resample(self,lenslet,pixel):
+    def _show_lenslet_resample(self,lenslet,pixel,overlaps):
         """docstring for _show_lenslet_resample"""
-        lenslet.show_geometry(color=pixel.get_color(lenslet.idx))
+        lenslet.show_geometry(color=pixel.get_color(overlaps,lenslet.idx))
     
     
     @description("Writing resample Matrix")
@@ -1431,9 +1918,10 @@ class SEDSimulator(Simulator,ImageStack):
     @ignore
     def _write_resample(self,lenslet,streama,streamb):
         """Write the resampleing matrix"""
-        string = "%(lenslet)d %(info)s %(spec)s\n" % { 'lenslet': lenslet.num, 'info': npArrayInfo(lenslet.pixelValues), 'array': lenslet.pixelValues , 'spec' : str(lenslet.spectrum)}
+        overlaps = self.crosstalk.getrow(lenslet.idx).toarray().ravel()
+        string = "%(lenslet)d %(info)s %(spec)s\n" % { 'lenslet': lenslet.num, 'info': npArrayInfo(overlaps), 'array': overlaps , 'spec' : str(lenslet.spectrum)}
         streama.write(string)
-        np.savetxt(streamb,lenslet.pixelValues)
+        np.savetxt(streamb,overlaps)
         
     
     #######################
@@ -1447,6 +1935,68 @@ class SEDSimulator(Simulator,ImageStack):
         self.map_over_collection(function,lambda l:l.num,collection,exceptions,color)
         
     
+    @ignore
+    def map_over_lenslets_in_pool(self,task,color="green",collect=None,lenslets=None):
+        """Maps a :class:`~SEDMachine.Parallel.LensletTask` over each lenslet (or over the given list of `lenslets`) using a pool of ``Parallel.workers`` processes, and displays a progress bar as lenslets are completed.
+        
+        Only the lenslet attributes named by the task are sent to the workers, and the attributes the task returns are set back on each lenslet. If `collect` is given, it is then called with each completed lenslet. Failed lenslets are logged and skipped."""
+        if lenslets is None:
+            lenslets = self.lenslets.values()
+        kernels = self.get_kernels() if task.kernels else None
+        with self.profiler.map(task.function,len(lenslets)):
+            pool = LensletPool(self.config["Parallel.workers"],self.config.extract(),kernels,self.config["Parallel.chunksize"])
+            self._start_progress_bar(len(lenslets),color)
+            try:
+                for num,state,error in pool.imap(task,lenslets):
+                    if error is not None:
+                        self.log.error("Lenslet %d failed in worker process" % num)
+                        self.log.debug(error)
+                    else:
+                        lenslet = self.lenslets[num]
+                        lenslet.import_state(state)
+                        if collect is not None:
+                            try:
+                                collect(lenslet)
+                            except Exception as e:
+                                self.log.error("Lenslet %d failed: %s" % (num,e))
+                    self.progress += 1
+                    self.progressbar.update(self.progress)
+            finally:
+                pool.close()
+            self._end_progress_bar()
+        
+    
+    @ignore
+    def map_over_shards_in_pool(self,task,shards,color="green"):
+        """Maps a :class:`~SEDMachine.Parallel.LensletTask` which places or reads subimages over groups of lenslets (see :meth:`_start_shards`) using a pool of ``Parallel.workers`` processes. Each worker merges the subimages of a whole group into a :class:`~SEDMachine.Objects.DetectorShard`, which is kept in ``shards``. The progress bar is updated as groups are completed. Failed lenslets are logged and skipped."""
+        count = sum(len(shard) for shard in shards)
+        kernels = self.get_kernels() if task.kernels else None
+        with self.profiler.map(task.function,count):
+            pool = LensletPool(self.config["Parallel.workers"],self.config.extract(),kernels,self.config["Parallel.chunksize"])
+            self._start_progress_bar(count,color)
+            try:
+                for index,shard,results in pool.imap_shards(task,shards,self.accumulator.data.shape,self.bounds):
+                    self.shards[index] = shard
+                    for num,state,error in results:
+                        if error is not None:
+                            self.log.error("Lenslet %d failed in worker process" % num)
+                            self.log.debug(error)
+                        else:
+                            self.lenslets[num].import_state(state)
+                        self.progress += 1
+                    self.progressbar.update(self.progress)
+            finally:
+                pool.close()
+            self._end_progress_bar()
+        
+    
+    @ignore
+    def map_over_collection(self,function,idfunction,collection,*args,**kwargs):
+        """Maps a function over a collection, as :meth:`AstroObject.AstroSimulator.Simulator.map_over_collection`, recording the time and memory used in the profiler."""
+        with self.profiler.map(function,len(collection)):
+            return super(SEDSimulator, self).map_over_collection(function,idfunction,collection,*args,**kwargs)
+        
+    
     @ignore
     def map_over_pixels(self,function,exceptions=True,color="green"):
         """Maps some function over a bunch of source pixels"""
@@ -1461,38 +2011,33 @@ class SEDSimulator(Simulator,ImageStack):
     
     @ignore
     def generate_poisson_noise(self,label=None,lam=2.0,num=1):
-        """Generates a poisson noise mask, saving to this object"""
+        """Generates a poisson noise mask, saving to this object. The mask is drawn one tile (``Instrument.tile.px``) at a time."""
         distribution = np.random.poisson
         shape = (self.config["Instrument.ccd.size.px"],self.config["Instrument.ccd.size.px"])
         if label == None:
             label = "Poisson Noise Mask (%2g)" % (lam)
-        arguments = (lam,shape)
-        noise = np.zeros(shape)
-        for i in range(num):
-            noise += distribution(*arguments)
+        noise = np.zeros(shape,dtype=self.config["Precision.accumulator"])
+        for tile in detector_tiles(shape,self.config["Instrument.tile.px"]):
+            for i in range(num):
+                noise[tile] += distribution(lam,noise[tile].shape)
         self.save(noise,label)
     
+    @ignore
+    def get_kernels(self):
+        """Return the :class:`~SEDMachine.Kernels.ConvolutionKernels` object for this simulator, creating it if required. The kernels object holds the PSF and telescope kernels independently of the simulator, so that it can be sent to worker processes.
+        
+        The elliptical kernel cache is limited by ``Kernels.size`` (number of kernels) and ``Kernels.memory`` (in MB). When ``Kernels.disk`` is set, kernels are also stored in the ``Caches.Kernels`` directory for later runs. Stored kernels are not read when caches are cleared, and not written when caching is disabled."""
+        if self.kernels is None:
+            directory = self.config["Caches.Kernels"] if self.config["Kernels.disk"] else None
+            self.kernels = ConvolutionKernels(self.config.extract(),self.Caches["PSF"],self.Caches["CONV"],
+                size=self.config["Kernels.size"],memory=self.config["Kernels.memory"],directory=directory,
+                load=not self.config["Options"].get("clear_cache",False),store=self.config["Options"].get("cache",True))
+        return self.kernels
+    
     @ignore
     def get_conv(self,wavelength,a=None,b=None,rot=None):
-        """Return a PSF for a given wavelength in the system"""
-        if a and b:
-            ai = int(a)
-            bi = int(b)
-            ri = int(rot * 180.0 / np.pi)
-            if ai not in self.ellipses:
-                self.ellipses[ai] = {}
-            if bi not in self.ellipses[ai]:
-                self.ellipses[ai][bi] = {}
-            if ri not in self.ellipses[ai][bi]:
-                ETEL = self.get_tel_kern(a,b)
-                self.CONV = sp.signal.fftconvolve(self.Caches["PSF"],ETEL,mode='same')
-                self.ellipses[ai][bi][ri] = self.CONV
-            else:
-                self.CONV = self.ellipses[ai][bi][ri]
-        if not hasattr(self,"found"):
-            self.found = True
-            self.CONV = self.Caches["CONV"] 
-        return self.CONV
+        """Return a PSF for a given wavelength in the system. See :meth:`SEDMachine.Kernels.ConvolutionKernels.get_conv`."""
+        return self.get_kernels().get_conv(wavelength,a,b,rot)
     
     @ignore
     def psf_kern(self,filename,size=0,truncate=False,header_lines=18):
@@ -1527,52 +2072,14 @@ class SEDSimulator(Simulator,ImageStack):
     
     @ignore
     def ellipse_kern(self,major,minor,alpha=0,size=0,sizey=False,normalize=False):
-        """docstring for elipse_kern"""
-        size /= 2
-        sizey /= 2
-        
-        if size < sizey:
-            size = sizey
-        if size < major:
-            size = int(major) + 1
-        sizey = size
-        
-        major = float(major)
-        minor = float(minor)
-        alpha = float(alpha)
-        
-        x, y = np.mgrid[-size:size+1, -sizey:sizey+1]
-        
-        d = np.sqrt(((x * np.cos(alpha) + y * np.sin(alpha))/minor)**2.0 + ((x * np.sin(alpha) + y * np.cos(alpha))/major)**2.0)
-        
-        v = (d <= 1).astype(np.float)
-        if normalize:
-            return v / np.sum(v)
-        else:
-            return v
-        
+        """Generate an elliptical kernel. See :func:`SEDMachine.Kernels.ellipse_kern`."""
+        return ellipse_kern(major,minor,alpha,size,sizey,normalize)
         
     
     @ignore
     def circle_kern(self,radius,size=0,sizey=0,normalize=False):
-        """Generate a Circle Kernel for modeling the \"Image of the Telescope\". The radius should be set in array units.
-        
-        `size` will determine the size of the array image, unless `size` is less than `radius`, in which case the image will be automatically increased to fit the entire circle.
-        
-        `normalize` controls whether the data is normalized or not. If it is not normalized, the data will have only 1.0 and 0.0 values, where 1.0 is within the radius, and 0.0 is outside the raidus."""
-        size /= 2
-        if size < radius:
-            size = int(radius)
-        else:
-            size = int(size)
-        radius = int(radius)
-        x, y = np.mgrid[-size:size+1, -size:size+1]
-        d = np.sqrt(x**2.0 + y**2.0)
-        v = (d <= radius).astype(np.float)
-        if normalize:
-            return v / np.sum(v)
-        else:
-            return v
+        """Generate a Circle Kernel for modeling the \"Image of the Telescope\". See :func:`SEDMachine.Kernels.circle_kern`."""
+        return circle_kern(radius,size,sizey,normalize)
     
     @ignore
     def gauss_kern(self,stdev,size=0,stdevy=None,sizey=None,enlarge=True,normalize=True):
@@ -1607,21 +2114,8 @@ class SEDSimulator(Simulator,ImageStack):
     
     @ignore
     def get_tel_kern(self,major=None,minor=None):
-        """Returns the telescope kernel. This kernel is built by creating a circle mask for the size of the telescope mirror, and then subtracting a telescope obscuration from the center of the mirror image. The values for all of these items are set in the configuration file."""
-        if major or minor:
-            
-            
-            
-            TELIMG = self.ellipse_kern( major, minor )
-            center = self.ellipse_kern( major * self.config["Instrument.Tel.obsc.ratio"], minor * self.config["Instrument.Tel.obsc.ratio"], *TELIMG.shape )
-        else:
-            TELIMG = self.circle_kern( self.config["Instrument.Tel.radius.px"] * self.config["Instrument.density"] )
-            center = self.circle_kern( self.config["Instrument.Tel.obsc.px"] * self.config["Instrument.density"] ,
-                *TELIMG.shape )
-        TELIMG -= center
-        TELIMG = TELIMG / np.sum(TELIMG)
-        self.log.debug(npArrayInfo(TELIMG,"TELIMG"))
-        return TELIMG
+        """Returns the telescope kernel. This kernel is built by creating a circle mask for the size of the telescope mirror, and then subtracting a telescope obscuration from the center of the mirror image. The values for all of these items are set in the configuration file. See :func:`SEDMachine.Kernels.tel_kern`."""
+        return tel_kern(self.config,major,minor)
     
     @ignore
     def get_psf_kern(self):
@@ -1680,6 +2174,18 @@ class SEDSimulator(Simulator,ImageStack):
         
         self.config["Instrument.wavelengths.values"] = wl
         self.config["Instrument.wavelengths.resolutions"] = r
+        
+        if self.config["Options"].get("workers",None) is not None:
+            self.config["Parallel.workers"] = self.config["Options"]["workers"]
+        if self.config["Options"].get("cache_subimages",False):
+            self.config["Subimages.cache"] = True
+        if self.config["Options"].get("profile",False):
+            self.config["Profile.report"] = True
+        if self.config["Options"].get("profile_stages",False):
+            self.config["Profile.cprofile"] = True
+        if self.config["Profile.cprofile"]:
+            self.profiler.directory = self._profile_directory()
+            self.profiler.prefix = self.config["Output.Label"]
             
     @ignore
     def get_resolution_spectrum(self,minwl,maxwl,resolution):
@@ -18,6 +18,8 @@ from AstroObject.AstroSimulator import *
 from AstroObject.AstroSpectra import SpectraStack
 import AstroObject.Utilities as AOU
 
+from synthetic import write_rays, write_encircled_energy, write_throughput
+
 # Background Functions
 def abmag_to_flambda(AB , lam):
     # Ab magnitude
@@ -133,6 +135,26 @@ class SetupAgent(Simulator):
         palSKY.save(palskydata,"PalSky")
         palSKY.write(clobber=True)
     
+    @depends("setup-dirs")
+    @help("Write a synthetic instrument to the data directory")
+    def make_synthetic(self):
+        """Write a synthetic ray table, encircled energy file and throughput file (see :mod:`SEDTools.synthetic`) to the data directory, using the filenames in the ``Instrument`` configuration, so that :program:`SEDMsim` can be run without the real instrument data, or with a different number of lenslets. The generator is configured by the ``Synthetic`` configuration section, where ``lenslets`` is the number of lenslets, and the other values are passed to :func:`SEDTools.synthetic.make_rays`::
+            
+            Synthetic:
+              lenslets: 10000
+              samples: 30
+              model: prism
+            
+        .. Warning::
+            This overwrites any ray table, encircled energy and throughput files in the data directory."""
+        options = dict(self.config["Synthetic"]) if "Synthetic" in self.config else {}
+        number = options.pop("lenslets",1000)
+        dataDir = self.config["Dirs"]["Data"] + "/"
+        write_rays(dataDir + self.config["Instrument"]["files"]["lenslets"],number,**options)
+        write_encircled_energy(dataDir + self.config["Instrument"]["files"]["encircledenergy"])
+        write_throughput(dataDir + self.config["Instrument"]["Thpt"]["File"])
+        self.log.info("Wrote a synthetic instrument with %d lenslets to %s" % (number,dataDir))
+    
     @depends("setup-dirs")    
     @help("Generate a basic configuration file for this data set.")
     def config_file(self):
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  synthetic.py
+#  Synthetic instrument data for scaling tests and benchmarks.
+#  SED
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#
+"""
+Synthetic instrument data, written in the same formats as the ZEMAX and throughput files used by :program:`SEDMsim`, so that the simulator can be run without the real instrument data, and with more (or fewer) lenslets than the real instrument.
+
+- :func:`write_rays` writes a ray table with the 13 columns read by :meth:`SEDMachine.Simulator.SEDSimulator.setup_lenslets`.
+- :func:`write_encircled_energy` writes a ZEMAX-style encircled energy file for a gaussian PSF.
+- :func:`write_throughput` writes a throughput file, as read by :meth:`SEDMachine.Simulator.SEDSimulator.setup_sky`.
+
+"""
+
+import numpy as np
+
+__all__ = ["hexagonal_pupils","make_rays","write_rays","write_encircled_energy","write_throughput","DISPERSION_MODELS"]
+
+def _linear(lams,lmin,lmax):
+    """Linear dispersion, with position proportional to wavelength."""
+    return (lams - lmin) / (lmax - lmin)
+
+def _prism(lams,lmin,lmax):
+    """Prism dispersion, with position proportional to the inverse square of wavelength (a two-term Cauchy model), which spreads out the blue end of the spectrum."""
+    return (lmin**-2.0 - lams**-2.0) / (lmin**-2.0 - lmax**-2.0)
+
+DISPERSION_MODELS = {"linear":_linear,"prism":_prism}
+
+def hexagonal_pupils(number,pitch=0.0042,rotation=0.0):
+    """Return the x and y pupil positions (in mm) of `number` lenslets on a hexagonal grid with the given `pitch` (in mm), rotated by `rotation` (in degrees). The lenslets are ordered by distance from the center of the grid, so the first lenslet is at the origin."""
+    rings = int(np.ceil(np.sqrt(number / 3.0))) + 1
+    q, r = np.mgrid[-rings:rings+1,-rings:rings+1]
+    inside = np.abs(q + r) <= rings
+    q, r = q[inside].astype(np.float), r[inside].astype(np.float)
+    x = pitch * (q + r / 2.0)
+    y = pitch * r * np.sqrt(3.0) / 2.0
+    order = np.lexsort((np.arctan2(y,x),np.round(np.hypot(x,y) / pitch,6)))[:number]
+    angle = rotation * np.pi / 180.0
+    x, y = x[order], y[order]
+    return x * np.cos(angle) - y * np.sin(angle), x * np.sin(angle) + y * np.cos(angle)
+
+def make_rays(number,samples=30,pitch=0.0042,rotation=0.0,field=36.0,length=1.0,curvature=0.02,model="prism",wavelengths=(0.37,0.93),major=0.016,minor=0.012,spot=0.027,jitter=1e-4,seed=0):
+    """Make a synthetic ray table, returned as an array with one row for each spot and the 13 columns read by :meth:`SEDMachine.Simulator.SEDSimulator.setup_lenslets`: index, pupil x and y (mm), wavelength (microns), camera x and y (mm), the camera x and y of the next R=100 resolution element, the camera x and y of the major and minor axis extent of the telescope image, and the resolution.
+
+    Lenslets are placed on a hexagonal pupil grid (see :func:`hexagonal_pupils`), and the grid is magnified so that the centers of the spectra cover a circle `field` mm across on the detector. Each spectrum is dispersed along the detector y-axis, over `length` mm, following a dispersion model from :data:`DISPERSION_MODELS`, with a parabolic curve of `curvature` mm in x and gaussian position `jitter` (mm). The resolution is the dispersion across a `spot` mm image.
+
+    :param number: Number of lenslets
+    :param samples: Number of spots (wavelengths) for each lenslet
+    :param pitch: Lenslet pitch in the pupil (mm)
+    :param rotation: Pupil grid rotation (degrees)
+    :param field: Diameter of the detector area covered by the spectra (mm)
+    :param length: Length of each spectrum on the detector (mm)
+    :param curvature: Curvature of each spectrum in x (mm)
+    :param model: Name of the dispersion model, ``linear`` or ``prism``
+    :param wavelengths: Minimum and maximum wavelength (microns)
+    :param major: Major axis of the telescope image (mm)
+    :param minor: Minor axis of the telescope image (mm)
+    :param spot: Size of the spot used to find the resolution (mm)
+    :param jitter: Standard deviation of the random spot position errors (mm)
+    :param seed: Random seed
+    :returns: Array of shape ``(number * samples, 13)``
+
+    """
+    dispersion = DISPERSION_MODELS[model]
+    lmin, lmax = wavelengths
+    random = np.random.RandomState(seed)
+    xps, yps = hexagonal_pupils(number,pitch,rotation)
+    radius = np.max(np.hypot(xps,yps))
+    scale = field / (2.0 * radius) if radius > 0 else 1.0
+
+    # Each array has one row per lenslet and one column per sample
+    lams = np.tile(np.linspace(lmin,lmax,samples),(number,1))
+    position = dispersion(lams,lmin,lmax) - 0.5
+    xcs = (xps * scale)[:,np.newaxis] + curvature * position**2.0 + random.normal(0,jitter,lams.shape)
+    ycs = (yps * scale)[:,np.newaxis] + length * position
+
+    # The next R=100 resolution element, and the resolution
+    following = dispersion(lams * 1.01,lmin,lmax) - 0.5
+    xls = xcs + curvature * (following**2.0 - position**2.0)
+    yls = ycs + length * (following - position)
+    slope = (dispersion(lams * 1.0005,lmin,lmax) - dispersion(lams * 0.9995,lmin,lmax)) / (lams * 0.001)
+    rs = lams * length * np.abs(slope) / spot
+
+    # Telescope image extents
+    xas, yas = xcs + major, ycs
+    xbs, ybs = xcs, ycs + minor
+
+    ix = np.tile(np.arange(number)[:,np.newaxis],(1,samples))
+    pupils = [ np.tile(p[:,np.newaxis],(1,samples)) for p in (xps,yps) ]
+    return np.array([ a.ravel() for a in [ix] + pupils + [lams,xcs,ycs,xls,yls,xas,yas,xbs,ybs,rs] ]).T
+
+def write_rays(filename,number,**kwargs):
+    """Write a synthetic ray table for `number` lenslets in the ZEMAX text format read by :meth:`SEDMachine.Simulator.SEDSimulator.load_rays`. Keyword arguments are passed to :func:`make_rays`."""
+    np.savetxt(filename,make_rays(number,**kwargs),header="ix xps yps lams xcs ycs xls yls xas yas xbs ybs rs")
+
+def write_encircled_energy(filename,sigma=10.0,radius=None,points=200):
+    """Write an encircled energy file for a gaussian PSF with a standard deviation of `sigma` microns, out to `radius` microns (by default, five times `sigma`). The file has the 18 header lines of a ZEMAX encircled energy file, and two columns, the radius in microns and the fraction of encircled energy."""
+    if radius is None:
+        radius = 5.0 * sigma
+    r = np.linspace(0.0,radius,points)
+    fraction = 1.0 - np.exp(-r**2.0 / (2.0 * sigma**2.0))
+    np.savetxt(filename,np.array([r,fraction]).T,header="\n".join(["Synthetic encircled energy, sigma = %g microns" % sigma] + [""] * 17))
+
+def write_throughput(filename,wavelengths=(3700.0,9300.0),peak=0.3,points=200):
+    """Write a throughput file, as a ``.npy`` record with a ``lambda`` field (in angstroms) and throughput fields for each instrument configuration (``thpt-prism-PI``, ``thpt-prism-Andor`` and ``thpt-grating``). Each throughput is a smooth curve which reaches `peak` in the middle of the `wavelengths` range, and falls to a quarter of `peak` at each end."""
+    lam = np.linspace(wavelengths[0],wavelengths[1],points)
+    t = (lam - lam.mean()) / (lam[-1] - lam[0])
+    names = ("thpt-prism-PI","thpt-prism-Andor","thpt-grating")
+    curves = [ peak * np.exp(-(t - shift)**2.0 * 4.0 * np.log(4.0)) for shift in (0.0,0.05,-0.05) ]
+    record = np.zeros(1,dtype=[("lambda",np.float,(points,))] + [ (name,np.float,(points,)) for name in names ])
+    record["lambda"] = lam
+    for name,curve in zip(names,curves):
+        record[name] = curve
+    np.save(filename,record)
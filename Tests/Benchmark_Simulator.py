@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Benchmark_Simulator.py
+#  Benchmarks for the simulator hot paths, using synthetic instrument data.
+#  SED
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#
+"""
+Benchmarks for the SED Machine simulator hot paths. The benchmarks need no network access and no instrument data: a synthetic ray table, encircled energy file and source spectrum are written to a temporary directory, and the simulator is run on those at each combination of lenslet count and density.
+
+Each benchmarked step is timed (the best of ``--repeat`` runs) and the results are written to a JSON file. Each step is then compared to the baseline (``--baseline``, by default ``Benchmark_Simulator.baseline.json`` next to this script), and the benchmark fails (with exit status 1) if any step takes more than ``--threshold`` times as long as it did in the baseline.
+
+Baselines depend on the machine they were made on, so no baseline is included. Save one (with ``--save-baseline``) on the machine used for comparisons, before the change being measured, and then compare against it::
+
+    $ python Tests/Benchmark_Simulator.py --save-baseline
+    $ python Tests/Benchmark_Simulator.py --threshold 1.5
+
+The benchmark fails (with exit status 2) before running when the baseline is missing, unless ``--save-baseline`` or ``--no-compare`` is given. Use ``--no-compare`` to only time the steps::
+
+    $ python Tests/Benchmark_Simulator.py --lenslets 10 100 --densities 5 10 --no-compare
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import collections
+
+import numpy as np
+import yaml
+
+from SEDMachine.Simulator import SEDSimulator
+from SEDMachine.Objects import DispersionFits, SubImageStore
+from SEDTools.synthetic import write_rays, write_encircled_energy
+
+STEPS = ("setup_lenslets","find_dispersion","geometric_resample","get_trace","psf_kern","place_trace","image_merge","apply_scatter")
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),"Benchmark_Simulator.baseline.json")
+
+def write_spectrum(filename):
+    """Write a synthetic source spectrum, in angstroms and cgs units."""
+    WL = np.linspace(3000.0,10000.0,2000)
+    FL = 1e-15 * (1.0 + 0.5 * np.sin(WL / 300.0))
+    np.savetxt(filename,np.array([WL,FL]).T)
+
+class Timer(object):
+    """Accumulates the wall time of each named step."""
+    def __init__(self):
+        super(Timer, self).__init__()
+        self.times = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self,name):
+        """Time the enclosed block, adding the time to the step `name`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - start
+
+def make_simulator(directory,lenslets,density):
+    """Make a simulator in `directory` using the synthetic data, configured for the given number of lenslets and density."""
+    data = os.path.join(directory,"Data")
+    for name in ("Caches","Data","Images","Logs","Partials"):
+        os.mkdir(os.path.join(directory,name))
+    write_rays(os.path.join(data,"rays.dat"),lenslets,samples=12,field=5.6,length=1.0)
+    write_encircled_energy(os.path.join(data,"encircled_energy.dat"))
+    write_spectrum(os.path.join(data,"spectrum.dat"))
+    config = {
+        "Instrument" : {"density":density,"image":{"size":{"mm":8.0}},"ccd":{"size":{"px":512}}},
+        "Lenslets" : {"number":lenslets},
+        "Source" : {"Filename":"spectrum.dat"},
+        "logging" : {"console":{"enable":False},"file":{"enable":False}},
+    }
+    with open(os.path.join(directory,"SED.main.config.yaml"),"w") as stream:
+        yaml.dump(config,stream,default_flow_style=False)
+    os.chdir(directory)
+    SIM = SEDSimulator()
+    SIM.config["Options"] = {"clear_cache":True,"cache":False}
+    SIM.setup_configuration()
+    SIM.setup_caches()
+    SIM.setup_constants()
+    return SIM
+
+def run(lenslets,density):
+    """Run each benchmarked step once, for the given number of lenslets and density. Returns a dictionary of step times in seconds."""
+    timer = Timer()
+    directory = tempfile.mkdtemp(prefix="SEDMachine-benchmark-")
+    cwd = os.getcwd()
+    try:
+        SIM = make_simulator(directory,lenslets,density)
+        with timer("setup_lenslets"):
+            SIM.setup_lenslets()
+        SIM.setup_hexagons()
+        objects = SIM.lenslets.values()
+        with timer("find_dispersion"):
+            fits = DispersionFits.fit(objects,SIM.config)
+            for lenslet in objects:
+                lenslet.fits = fits.row(lenslet.num)
+            for lenslet in objects:
+                lenslet.find_dispersion()
+        for lenslet in objects:
+            lenslet.trace_geometry()
+        SIM.setup_simple_source()
+        SIM.setup_source_pixels()
+        with timer("geometric_resample"):
+            SIM.geometric_resample()
+        with timer("get_trace"):
+            for lenslet in objects:
+                lenslet.get_trace(lenslet.spectrum)
+        with timer("psf_kern"):
+            SIM.get_psf_kern()
+        get_conv = SIM.get_kernels().get_conv
+        SIM.setup_blank()
+        store = SubImageStore(SIM.config["Caches.Subimages"],SIM.config["Precision.subimage"]).open("w")
+        for lenslet in objects:
+            with timer("place_trace"):
+                lenslet.place_trace(get_conv)
+            lenslet.write_subimage(store)
+        store.close()
+        with timer("image_merge"):
+            SIM.image_merge()
+        SIM.ccd_crop()
+        SIM.setup_scatter()
+        with timer("apply_scatter"):
+            SIM.apply_scatter()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return dict(timer.times)
+
+def benchmark(counts,densities,repeat):
+    """Run the benchmarks for each combination of lenslet count and density, keeping the best time of `repeat` runs for each step. Results are keyed by ``<lenslets>x<density>``."""
+    results = {}
+    for lenslets in counts:
+        for density in densities:
+            best = {}
+            for i in range(repeat):
+                for step,value in run(lenslets,density).iteritems():
+                    best[step] = min(value,best.get(step,value))
+            results["%dx%d" % (lenslets,density)] = best
+            print "%5d lenslets, density %2d: %s" % (lenslets,density,", ".join("%s=%.3fs" % (step,best[step]) for step in STEPS if step in best))
+    return results
+
+def compare(results,baseline,threshold):
+    """Return a list of ``(case, step, time, baseline time)`` for each step which took more than `threshold` times as long as in the `baseline`. Cases and steps which are not in the baseline are skipped."""
+    regressions = []
+    for case,times in sorted(results.iteritems()):
+        for step,value in sorted(times.iteritems()):
+            reference = baseline.get(case,{}).get(step,None)
+            if reference is not None and value > threshold * reference:
+                regressions.append((case,step,value,reference))
+    return regressions
+
+def main(arguments=None):
+    """Run the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmark the SED Machine simulator hot paths with synthetic data")
+    parser.add_argument("--lenslets",type=int,nargs="+",default=[10,100],metavar="N",help="Numbers of lenslets to simulate")
+    parser.add_argument("--densities",type=int,nargs="+",default=[5,10],metavar="D",help="Instrument densities to simulate")
+    parser.add_argument("--repeat",type=int,default=3,help="Number of runs of each case, keeping the best time")
+    parser.add_argument("--output",default="Benchmark_Simulator.json",help="File for the benchmark results")
+    parser.add_argument("--baseline",default=BASELINE,help="Baseline results to compare against")
+    parser.add_argument("--threshold",type=float,default=1.5,help="Fail when a step takes more than this multiple of the baseline time")
+    parser.add_argument("--save-baseline",action="store_true",dest="save_baseline",help="Save the results as the new baseline")
+    parser.add_argument("--no-compare",action="store_false",dest="compare",help="Only time the steps, without comparing them to the baseline")
+    options = parser.parse_args(arguments)
+    if options.compare and not options.save_baseline and not os.path.exists(options.baseline):
+        print "No baseline %s, save one with --save-baseline or use --no-compare." % options.baseline
+        return 2
+
+    results = benchmark(options.lenslets,options.densities,options.repeat)
+    with open(options.output,"w") as stream:
+        json.dump(results,stream,indent=2,sort_keys=True)
+    if options.save_baseline:
+        with open(options.baseline,"w") as stream:
+            json.dump(results,stream,indent=2,sort_keys=True)
+        print "Saved baseline %s" % options.baseline
+        return 0
+    if not options.compare:
+        return 0
+    with open(options.baseline,"r") as stream:
+        baseline = json.load(stream)
+    regressions = compare(results,baseline,options.threshold)
+    for case,step,value,reference in regressions:
+        print "REGRESSION %s %s: %.3fs (baseline %.3fs)" % (case,step,value,reference)
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
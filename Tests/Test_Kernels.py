@@ -0,0 +1,81 @@
+#
+#  Test_Kernels.py
+#  Simulation Software
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import nose.tools as nt
+
+from SEDMachine.Kernels import ConvolutionKernels, kernel_keys
+
+class Test_ConvolutionKernels(object):
+    """ConvolutionKernels"""
+
+    def setUp(self):
+        """Make a small PSF and configuration"""
+        x, y = np.mgrid[-5:6,-5:6]
+        self.psf = np.exp(-(x**2.0 + y**2.0) / 4.0)
+        self.psf /= np.sum(self.psf)
+        self.config = {"Instrument":{"Tel":{"obsc":{"ratio":0.1,"px":0.2},"radius":{"px":1.2}},"density":5}}
+
+    def kernels(self,**kwargs):
+        """Return a new kernels object"""
+        return ConvolutionKernels(self.config,self.psf,self.psf,**kwargs)
+
+    def test_kernel_depends_only_on_key(self):
+        """Kernels which share a key are the same, whichever parameters reached the key first"""
+        first, second = self.kernels(), self.kernels()
+        a = first.get_conv(5e-7,5.1,3.1,0.0)
+        b = second.get_conv(5e-7,5.9,3.9,0.0)
+        nt.eq_(first.key(5.1,3.1,0.0),second.key(5.9,3.9,0.0))
+        assert np.array_equal(a,b)
+
+    def test_kernel_after_eviction(self):
+        """Kernels are the same after they are evicted and made again"""
+        kernels = self.kernels(size=1)
+        a = kernels.get_conv(5e-7,5.1,3.1,0.0).copy()
+        kernels.get_conv(5e-7,8.0,6.0,0.0)
+        b = kernels.get_conv(5e-7,5.9,3.9,0.0)
+        nt.eq_(kernels.evictions,2)
+        assert np.array_equal(a,b)
+
+    def test_keys_match_cache(self):
+        """kernel_keys agrees with the cache key for each point"""
+        kernels = self.kernels()
+        a, b, rot = np.array([5.1,5.9,7.2]), np.array([3.1,3.9,2.5]), np.array([0.0,0.3,1.0])
+        keys = kernel_keys(a,b,rot)
+        for i in range(len(a)):
+            nt.eq_(tuple(keys[1:,i]),kernels.key(a[i],b[i],rot[i]))
+
+    def test_disk_store_flags(self):
+        """The on-disk store is only written with store, and only read with load"""
+        directory = tempfile.mkdtemp()
+        try:
+            self.kernels(directory=directory,store=False).get_conv(5e-7,5.1,3.1,0.0)
+            nt.eq_(len(os.listdir(directory)),0)
+            self.kernels(directory=directory).get_conv(5e-7,5.1,3.1,0.0)
+            nt.eq_(len(os.listdir(directory)),1)
+            loaded = self.kernels(directory=directory)
+            loaded.get_conv(5e-7,5.1,3.1,0.0)
+            nt.eq_(loaded.loads,1)
+            ignored = self.kernels(directory=directory,load=False)
+            ignored.get_conv(5e-7,5.1,3.1,0.0)
+            nt.eq_(ignored.loads,0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_empty_copy(self):
+        """An empty copy has no cached kernels, and returns the same kernels as a warm cache"""
+        warm = self.kernels()
+        a = warm.get_conv(5e-7,5.9,3.9,0.0)
+        fresh = warm.empty()
+        nt.eq_(len(fresh.ellipses),0)
+        nt.eq_(fresh.misses,0)
+        assert np.array_equal(a,fresh.get_conv(5e-7,5.1,3.1,0.0))
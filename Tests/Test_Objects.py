@@ -0,0 +1,162 @@
+#
+#  Test_Objects.py
+#  Simulation Software
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#
+
+import numpy as np
+import nose.tools as nt
+
+from AstroObject.AstroConfig import StructuredConfiguration
+
+from SEDMachine.Objects import Lenslet, SEDLimits, ResponseOperator, DetectorAccumulator, DetectorShard, shard_lenslets, shard_bounds, reduce_shards, block_bin
+
+def explicit_bin(array,factor):
+    """Bin an array by summing each block with an explicit loop, including partial blocks at the far edges."""
+    nx, ny = -(-array.shape[0] // factor), -(-array.shape[1] // factor)
+    out = np.zeros((nx,ny))
+    for i in range(nx):
+        for j in range(ny):
+            out[i,j] = np.sum(array[i * factor:(i + 1) * factor,j * factor:(j + 1) * factor])
+    return out
+
+class Test_block_bin(object):
+    """block_bin"""
+
+    def setUp(self):
+        """Make a random array with partial blocks in both directions"""
+        self.array = np.random.RandomState(0).rand(23,17)
+        self.factor = 5
+
+    def test_full_blocks(self):
+        """Full blocks match an explicit block sum"""
+        binned = block_bin(self.array,self.factor)
+        nt.eq_(binned.shape,(4,3))
+        assert np.allclose(binned,explicit_bin(self.array,self.factor)[:4,:3])
+
+    def test_partial_blocks(self):
+        """Partial blocks match an explicit block sum, and conserve flux"""
+        binned = block_bin(self.array,self.factor,partial=True)
+        nt.eq_(binned.shape,(5,4))
+        assert np.allclose(binned,explicit_bin(self.array,self.factor))
+        assert np.allclose(np.sum(binned),np.sum(self.array))
+
+    def test_out(self):
+        """Results are written into out, which must have the binned shape"""
+        out = np.zeros((4,3))
+        nt.ok_(block_bin(self.array,self.factor,out) is out)
+        assert np.allclose(out,explicit_bin(self.array,self.factor)[:4,:3])
+        nt.assert_raises(ValueError,block_bin,self.array,self.factor,np.zeros((5,4)))
+
+class Test_Lenslet_deposit(object):
+    """Lenslet._deposit"""
+
+    def setUp(self):
+        """Make a kernel and some points"""
+        random = np.random.RandomState(1)
+        x, y = np.mgrid[-3:4,-3:4]
+        self.kernel = np.exp(-(x**2.0 + y**2.0) / 3.0)
+        self.xs = random.uniform(4,36,50)
+        self.ys = random.uniform(4,26,50)
+        self.fluxes = random.uniform(0,10,50)
+        self.lenslet = Lenslet.__new__(Lenslet)
+
+    def test_matches_point_loop(self):
+        """Depositing all points at once matches placing each point in turn"""
+        expected = np.zeros((40,30))
+        n = self.kernel.shape[0]
+        for x,y,flux in zip(self.xs,self.ys,self.fluxes):
+            xstart, ystart = int(np.floor(x - n/2.0)), int(np.floor(y - n/2.0))
+            expected[xstart:xstart + n,ystart:ystart + n] += self.kernel * flux
+        img = np.zeros((40,30))
+        self.lenslet._deposit(img,self.kernel,self.xs,self.ys,self.fluxes,chunk=7)
+        assert np.allclose(img,expected)
+
+    def test_limits(self):
+        """Points whose kernel falls off the image raise SEDLimits"""
+        img = np.zeros((40,30))
+        nt.assert_raises(SEDLimits,self.lenslet._deposit,img,self.kernel,np.array([1.0]),np.array([10.0]),np.array([1.0]))
+
+    def test_contiguous(self):
+        """Images which are not C-contiguous raise ValueError, rather than losing the deposited flux"""
+        img = np.zeros((30,40)).T
+        nt.assert_raises(ValueError,self.lenslet._deposit,img,self.kernel,self.xs,self.ys,self.fluxes)
+
+def make_lenslet(num=1,corner=(3,4),points=40,seed=2):
+    """Make a traced lenslet with a random trace on a small subimage, for a detector 30 px across at density 4."""
+    random = np.random.RandomState(seed)
+    config = StructuredConfiguration({"Instrument":{"density":4,"image":{"size":{"px":30}},"Tel":{"ellipse":False}},"Precision":{"subimage":"float64"}})
+    state = dict(num=num,txs=random.uniform(5,35,points),tys=random.uniform(5,19,points),twl=np.linspace(4e-7,9e-7,points),
+        tfl=random.uniform(0,100,points),subshape=(41,24),subcorner=corner,traced=True)
+    return Lenslet.from_state(state,config)
+
+def get_conv(wavelength,a=None,b=None,rot=None):
+    """A fixed convolution kernel"""
+    x, y = np.mgrid[-2:3,-2:3]
+    return np.exp(-(x**2.0 + y**2.0) / 2.0)
+
+class Test_ResponseOperator(object):
+    """ResponseOperator"""
+
+    def test_matches_place_bin_merge(self):
+        """The response operator image matches placing, binning and merging each subimage"""
+        lenslets = [ make_lenslet(1,(3,4),seed=2), make_lenslet(2,(15,10),seed=3) ]
+        operator = ResponseOperator("response.npz","key",(30,30))
+        accumulator = DetectorAccumulator(np.zeros((30,30)))
+        for lenslet in lenslets:
+            operator.add(lenslet.num,lenslet.response(get_conv))
+            lenslet.place_trace(get_conv)
+            lenslet.merge_subimage(accumulator)
+        image = operator.apply(dict((lenslet.num,lenslet.tfl) for lenslet in lenslets))
+        assert np.allclose(image,accumulator.data)
+        assert np.allclose(lenslets[0].response(get_conv).dot(lenslets[0].tfl).sum(),block_bin(lenslets[0].data(),4).sum())
+
+class Test_Shards(object):
+    """DetectorShard and reduce_shards"""
+
+    def setUp(self):
+        """Make binned subimages of some lenslets on a 60 px detector"""
+        random = np.random.RandomState(4)
+        self.lenslets = []
+        for num in range(25):
+            lenslet = Lenslet.__new__(Lenslet)
+            lenslet.num = num
+            lenslet.subcorner = (random.randint(0,45),random.randint(0,50))
+            lenslet.subshape = (random.randint(20,70),random.randint(20,45))
+            lenslet.image = random.rand(lenslet.subshape[0],lenslet.subshape[1])
+            self.lenslets.append(lenslet)
+
+    def merge(self,shards,bounds=True):
+        """Merge the lenslets in the given number of shards, and return the detector image"""
+        accumulator = DetectorAccumulator(np.zeros((60,60)))
+        parts = []
+        for group in shard_lenslets(self.lenslets,shards):
+            shard = DetectorShard((60,60),bounds=shard_bounds(group,5,(60,60)) if bounds else None)
+            for lenslet in group:
+                shard.add_binned(lenslet.image,5,lenslet.subcorner)
+            parts.append(shard)
+        shard = reduce_shards(parts)
+        accumulator.add(shard.data,shard.corner)
+        return accumulator.data
+
+    def test_single_buffer(self):
+        """Merging in shards matches adding each subimage into one buffer"""
+        accumulator = DetectorAccumulator(np.zeros((60,60)))
+        for lenslet in self.lenslets:
+            accumulator.add_binned(lenslet.image,5,lenslet.subcorner)
+        for shards in (1,3,7):
+            assert np.allclose(self.merge(shards),accumulator.data)
+
+    def test_bounds(self):
+        """Shards allocated from their bounds do not grow, and match shards which grow"""
+        for group in shard_lenslets(self.lenslets,4):
+            bounds = shard_bounds(group,5,(60,60))
+            shard = DetectorShard((60,60),bounds=bounds)
+            data = shard.data
+            for lenslet in group:
+                shard.add_binned(lenslet.image,5,lenslet.subcorner)
+            nt.ok_(shard.data is data)
+            nt.eq_(shard.bounds,bounds)
+        assert np.array_equal(self.merge(4),self.merge(4,bounds=False))
@@ -0,0 +1,113 @@
+#
+#  Test_Parallel.py
+#  Simulation Software
+#
+#  Created by Alexander Rudy on 2012-10-18.
+#  Copyright 2012 Alexander Rudy. All rights reserved.
+#
+
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyfits as pf
+import yaml
+import nose.tools as nt
+
+from AstroObject.AstroSpectra import SpectraStack
+
+from SEDMachine.Simulator import SEDSimulator
+from SEDTools.synthetic import write_rays, write_encircled_energy, write_throughput
+
+def make_simulator(directory,stages):
+    """Make a simulator with 40 synthetic lenslets in `directory`, and run the given stages. Flat sky and atmosphere spectra are written for each of the ``Observation.Background.Files``."""
+    for name in ("Caches","Data","Images","Logs","Partials"):
+        os.mkdir(os.path.join(directory,name))
+    data = os.path.join(directory,"Data")
+    write_rays(os.path.join(data,"rays.dat"),40,samples=12,field=5.6,length=1.0)
+    write_encircled_energy(os.path.join(data,"encircled_energy.dat"))
+    write_throughput(os.path.join(data,"thpt.npy"))
+    WL = np.linspace(3000.0,10000.0,500)
+    np.savetxt(os.path.join(data,"spectrum.dat"),np.array([WL,1e-15 * np.ones(WL.shape)]).T)
+    config = {
+        "Instrument" : {"density":5,"image":{"size":{"mm":8.0}},"ccd":{"size":{"px":512}}},
+        "Lenslets" : {"number":40},
+        "Parallel" : {"shards":4},
+        "Source" : {"Filename":"spectrum.dat"},
+        "logging" : {"console":{"enable":False},"file":{"enable":False}},
+    }
+    with open(os.path.join(directory,"SED.main.config.yaml"),"w") as stream:
+        yaml.dump(config,stream,default_flow_style=False)
+    os.chdir(directory)
+    SIM = SEDSimulator()
+    SIM.config["Options"] = {"clear_cache":True,"cache":False}
+    SIM.setup_configuration()
+    for label,files in SIM.config["Observation.Background.Files"].iteritems():
+        value = 0.1 if label == SIM.config["Observation.Background.Atmosphere"] else 1e-17
+        stack = SpectraStack(filename=os.path.join(data,files["Filename"]))
+        stack.save(np.array([WL,value * np.ones(WL.shape)]),label)
+        stack.write(clobber=True)
+    for stage in stages:
+        getattr(SIM,stage)()
+    return SIM
+
+class Test_ShardedMerge(object):
+    """Sharded merging with worker processes"""
+
+    def setUp(self):
+        """Make a simulator with synthetic data in a temporary directory, and trace each lenslet"""
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="SEDMachine-test-")
+        self.SIM = make_simulator(self.directory,("setup_caches","setup_constants","setup_lenslets","setup_hexagons","lenslet_dispersion",
+            "setup_simple_source","setup_source_pixels","geometric_resample","lenslet_trace","setup_blank"))
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def merge(self,workers):
+        """Place and merge every lenslet with the given number of workers, and return the merged image"""
+        self.SIM.config["Parallel.workers"] = workers
+        self.SIM.lenslet_place()
+        return self.SIM.data("Merge").copy()
+
+    def test_workers(self):
+        """The merged image is the same for any number of workers"""
+        serial = self.merge(1)
+        assert np.sum(serial) > 0
+        for workers in (2,3):
+            assert np.array_equal(serial,self.merge(workers))
+
+class Test_Sweep(object):
+    """Sweeps over source configurations"""
+
+    def setUp(self):
+        """Make a simulator with a flat source, and a sweep file with a grid of flat source values"""
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="SEDMachine-test-")
+        self.SIM = make_simulator(self.directory,("setup_caches","setup_constants","setup_lenslets","setup_hexagons","lenslet_dispersion",
+            "setup_blank","setup_cameras","setup_scatter","flat_source"))
+        filename = os.path.join(self.directory,"sweep.yaml")
+        with open(filename,"w") as stream:
+            yaml.dump({"Grid":{"Source.Flat.value":[1e-3,1e-1]}},stream,default_flow_style=False)
+        self.SIM.config["Options"]["sweep"] = filename
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_flat_values(self):
+        """Each flat source value in a sweep gives a different image"""
+        self.SIM.sweep()
+        filenames = sorted(name for name in glob.glob(os.path.join(self.directory,"Images","*.fits")) if "-deep-" not in name)
+        nt.eq_(len(filenames),2)
+        assert not np.array_equal(pf.getdata(filenames[0]),pf.getdata(filenames[1]))
+
+    def test_no_source_stage(self):
+        """Source overrides without a source stage are an error"""
+        self.SIM.source_stage = None
+        nt.assert_raises(ValueError,self.SIM.sweep)